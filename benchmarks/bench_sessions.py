@@ -0,0 +1,70 @@
+# -*- coding: UTF-8 -*-
+'''
+	Compares session file layouts and formats: time to look up and load random sessions
+	in stores of different sizes.
+	
+	python benchmarks/bench_sessions.py --counts 10000 100000 1000000
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import phemia
+
+LAYOUTS	= (
+	("flat json",		{"shards": 0, "format": 'json',		"extension": 'txt'}),
+	("sharded json",	{"shards": 2, "format": 'json',		"extension": 'txt'}),
+	("sharded marshal",	{"shards": 2, "format": 'marshal',	"extension": 'bin'})
+)
+
+def document(i):
+	return {
+		"last_update"	: int(time.time()),
+		"name"			: "user %d" % (i),
+		"state"			: {"step": i % 7, "language": "en", "flags": [True, False, None]},
+		"history"		: ["message %d" % (n) for n in range(7)]
+	}
+
+def bench(count,lookups,options):
+	path	= tempfile.mkdtemp(prefix='phemia-bench-')
+	try:
+		session	= phemia.Session({"raw": dict(options, path=path, locking=False, migrate=False)})
+		start	= time.perf_counter()
+		for i in range(count):
+			session.file_command('set', str(i), document(i))
+		write	= time.perf_counter()-start
+		
+		ids		= [str(random.randrange(count)) for i in range(lookups)]
+		start	= time.perf_counter()
+		for id in ids:
+			session.file_command('get', id)
+		read	= time.perf_counter()-start
+		
+		size	= 0
+		for root, dirs, files in os.walk(path):
+			for name in files:
+				size	+= os.path.getsize(os.path.join(root, name))
+		return write/count, read/lookups, size/count
+	finally:
+		shutil.rmtree(path, ignore_errors=True)
+
+def main(argv=None):
+	parser	= argparse.ArgumentParser(description='Benchmark session file layouts.')
+	parser.add_argument('--counts', type=int, nargs='+', default=[10000, 100000], help='number of sessions to create')
+	parser.add_argument('--lookups', type=int, default=10000, help='number of random sessions to load')
+	args	= parser.parse_args(argv)
+	
+	print('%-10s %-16s %12s %12s %10s' % ('sessions', 'layout', 'write (us)', 'load (us)', 'bytes'))
+	for count in args.counts:
+		for name, options in LAYOUTS:
+			write, read, size	= bench(count, args.lookups, options)
+			print('%-10d %-16s %12.1f %12.1f %10.0f' % (count, name, write*1e6, read*1e6, size))
+
+if __name__ == '__main__':
+	main()
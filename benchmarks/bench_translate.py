@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+'''
+	Measures how many facebook webhook events per second Messaging.translate_all() normalizes,
+	using the webhook payloads in benchmarks/fixtures.
+	
+	python benchmarks/bench_translate.py
+	python benchmarks/bench_translate.py --baseline /path/to/other/phemia.py	# compare with another version
+'''
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import collections
+import collections.abc
+import importlib.util
+
+FIXTURES	= os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import phemia
+
+def load_module(name,path):
+	# older versions use collections.Mapping, which was removed in Python 3.10
+	if not hasattr(collections, 'Mapping'):
+		collections.Mapping	= collections.abc.Mapping
+	spec	= importlib.util.spec_from_file_location(name, path)
+	module	= importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def load_fixtures(pattern):
+	fixtures	= []
+	for path in sorted(glob.glob(os.path.join(FIXTURES, pattern))):
+		with open(path, 'r') as data:
+			fixtures.append((os.path.basename(path), json.load(data)))
+	return fixtures
+
+def count_events(data):
+	return sum(len(entry.get('messaging', [])) for entry in data.get('entry', []))
+
+def bench(messaging,data,seconds):
+	# older versions only have translate(), which handles the first event of a call
+	if hasattr(messaging, 'translate_all') and count_events(data)>1:
+		translate	= lambda data: list(messaging.translate_all(data))
+		events		= count_events(data)
+	else:
+		translate	= messaging.translate
+		events		= 1
+	calls	= 0
+	start	= time.perf_counter()
+	while True:
+		for i in range(100):
+			translate(data)
+		calls	+= 100
+		elapsed	= time.perf_counter()-start
+		if elapsed>=seconds:
+			return calls*events/elapsed
+
+def main(argv=None):
+	parser	= argparse.ArgumentParser(description='Benchmark the facebook event normalizer.')
+	parser.add_argument('--fixtures', default='facebook_*.json', help='glob of fixture files')
+	parser.add_argument('--seconds', type=float, default=0.5, help='time spent on each fixture')
+	parser.add_argument('--baseline', default=None, help='phemia.py of another version to compare with')
+	args	= parser.parse_args(argv)
+	
+	versions	= [('current', phemia)]
+	if args.baseline:
+		versions.append(('baseline', load_module('phemia_baseline', args.baseline)))
+	
+	print('%-28s' % ('fixture') + ''.join('%16s' % ('%s (ev/s)' % (name)) for name, module in versions))
+	for name, data in load_fixtures(args.fixtures):
+		results	= [bench(module.Messaging({"platform": "facebook"}), data, args.seconds) for version, module in versions]
+		print('%-28s' % (name) + ''.join('%16.0f' % (result) for result in results))
+
+if __name__ == '__main__':
+	main()
@@ -9,7 +9,28 @@ import json
 import requests
 import urllib
 import collections
+import collections.abc
+import codecs
 import time
+import threading
+import asyncio
+import concurrent.futures
+import queue
+import random
+import sqlite3
+import argparse
+import inspect
+import atexit
+import contextlib
+import zlib
+import hashlib
+import marshal
+import copy
+try:
+	import fcntl
+except ImportError:		# advisory file locks are only available on POSIX systems
+	fcntl	= None
+from requests.adapters import HTTPAdapter
 
 # Phemia - Python Messenger AI
 class Messaging:
@@ -22,6 +43,23 @@ class Messaging:
 	ALLOWED_FACEBOOK_SUBTITLE_LENGTH= 80
 	ALLOWED_FACEBOOK_BUTTONS_LENGTH	= 3
 	ALLOWED_FACEBOOK_MESSAGE_LENGTH	= 320
+	ALLOWED_FACEBOOK_BATCH_LENGTH	= 50
+	
+	FACEBOOK_RETRY_ERROR_CODES	= (1, 2, 4, 17, 32, 613)	# temporary errors and rate limits worth retrying
+	
+	# fields of facebook messaging events copied to message['other']: {section of the event: ((field, key), ...) or None to copy the section itself}
+	FACEBOOK_EVENT_FIELDS	= {
+		'timestamp'	: None,
+		'delivery'	: (('watermark', 'delivery'), ('mids', 'mids')),
+		'read'		: (('watermark', 'read'),),
+		'message'	: (('is_echo', 'is_echo'),)
+	}
+	
+	LOG_PAYLOAD_LENGTH	= 1000		# max. characters of received data written to the log
+	
+	FACEBOOK_GRAPH_VERSION	= 'v2.6'
+	FACEBOOK_GRAPH_URL_BASE	= 'https://graph.facebook.com/'
+	FACEBOOK_GRAPH_URL		= FACEBOOK_GRAPH_URL_BASE + FACEBOOK_GRAPH_VERSION + '/'
 	
 	
 	##### CONSTRUCTOR #####
@@ -29,6 +67,74 @@ class Messaging:
 		default_settings	= {
 			"platform"	: "facebook",			# use facebook by default
 			"log_file"	: None,					# error log file
+			"log"		: {						# variables for the log file (written by a background thread)
+				"buffer"			: 10000,	# max. records waiting to be written (further ones are dropped and counted)
+				"max_bytes"			: 10485760,	# rotate the file once it reaches this size, 0 to never rotate
+				"backups"			: 3,		# number of rotated files kept (log_file.1, log_file.2, ...)
+				"payload_length"	: self.LOG_PAYLOAD_LENGTH,	# max. characters of received data written with a record
+				"payload_sample"	: 1.0		# share of records written with their payload (the others only count as sampled)
+			},
+			"message_objects": False,			# translate() returns Message objects (with __slots__) instead of dicts
+			"keep_raw"	: True,					# keep the received data in message['raw']
+			"metrics"	: None,					# Metrics collecting stage timings and result counters (True creates one), None to disable
+			
+			"http"		: {						# connection pool shared by every outgoing request
+				"pool_connections"	: 4,		# number of hosts to keep connection pools for
+				"pool_maxsize"		: 10,		# number of connections kept alive per host
+				"pool_block"		: False,	# wait for a free connection instead of opening a new one
+				"max_retries"		: 1,		# retries for failed connections (requests are never resent)
+				"keep_alive"		: True		# reuse TCP+TLS connections between requests
+			},
+			
+			"cache"		: {						# LRU cache of compiled payloads (see compile)
+				"size"				: 256		# max. number of cached messages, 0 to disable
+			},
+			
+			"queue"		: {						# opt-in outbound queue: send() / reply() return immediately
+				"enabled"			: False,	# deliver messages from background worker threads
+				"workers"			: 4,		# number of worker threads (messages of a recipient always go to the same one)
+				"rate"				: 0,		# max. messages per second, 0 for unlimited
+				"burst"				: 10,		# max. messages sent at once after being idle
+				"retries"			: 5,		# max. retries on rate limits, server and network errors
+				"backoff"			: 0.5,		# seconds to wait before the first retry (doubled for every retry)
+				"max_backoff"		: 30,		# max. seconds to wait between retries
+				"callback"			: None		# called with (compiled message, result) once a message is delivered or given up on
+			},
+			
+			"outbox"	: {						# opt-in durable outbox: send() / reply() store messages on disk, drain_outbox() delivers them
+				"path"				: None,		# SQLite file of the outbox, None to disable
+				"retries"			: 10,		# max. delivery attempts before a message is marked as failed
+				"backoff"			: 5,		# seconds to wait before the first retry (doubled for every retry)
+				"max_backoff"		: 3600,		# max. seconds to wait between retries
+				"lease"				: 300		# seconds a message being sent is reserved for one drainer (taken over after a crash)
+			},
+			
+			"profiles"	: {						# cache of get_user_info() results
+				"size"				: 1024,		# max. number of profiles kept in memory, 0 to disable
+				"ttl"				: 86400,	# seconds a profile is reused before it is requested again
+				"error_ttl"			: 60,		# seconds a failed lookup is reused (avoids hammering the Graph API), 0 to disable
+				"session"			: None,		# Session to keep profiles in, so they survive between processes (CGI)
+				"session_key"		: 'profile'	# session key profiles are stored under
+			},
+			
+			"filters"	: {						# raw facebook events skipped before they are translated
+				"kinds"				: [],		# event kinds to skip ('text','postback','attachment','delivery','read','echo', see event_kind)
+				"senders"			: [],		# sender ids whose events are skipped
+				"recipients"		: [],		# page ids events are accepted for, empty for every page
+				"watermarks"		: False,	# collect delivery / read receipts in watermarks (per sender) instead of translating them, call pop_watermarks() after every webhook
+				"max_watermarks"	: 10000		# max. number of senders collected until pop_watermarks(), receipts of further senders are translated
+			},
+			
+			"dedup"		: {						# index of received message ids, facebook delivers webhooks again after timeouts
+				"size"				: 0,		# number of latest message ids kept in memory (e.g. 4096), 0 to disable
+				"drop"				: False,	# skip messages seen before (otherwise they are flagged with other['duplicate'])
+				"path"				: None,		# SQLite file keeping the ids between processes (CGI), None for memory only
+				"timeout"			: 30		# seconds to wait for locks held by other processes
+			},
+			
+			"async"		: {						# variables for send_async / reply_async / send_all_async
+				"concurrency"		: 10		# max. number of requests in flight (keep <= http.pool_maxsize)
+			},
 			
 			"facebook"	: {						# variables for facebook messaging
 				"access_token"		: None,		# facebook access token
@@ -47,18 +153,59 @@ class Messaging:
 			}
 		}	
 		self.settings		= deep_dict_merge(default_settings,options)
+		self.metrics		= Metrics() if self.settings['metrics'] is True else self.settings['metrics']
+		log					= self.settings['log']
+		self.logger			= Logger(self.settings['log_file'], log['buffer'], log['max_bytes'], log['backups'], log['payload_length'], log['payload_sample']) if self.settings['log_file'] else None
+		self._local			= threading.local()
 		self.last_sender	= {}
 		self.last_recipient	= {}
+		self.http			= None
+		self._http_lock		= threading.Lock()
+		self._executor		= None
+		self.cache			= LRUCache(self.settings['cache']['size'])
+		self.queue			= None
+		self.outbox			= None
+		self.watermarks		= {}				# sender id => {"delivery": watermark, "read": watermark} (see pop_watermarks)
+		self._watermarks_lock	= threading.Lock()
+		self._filters		= self._compile_filters(self.settings['filters'])
+		dedup				= self.settings['dedup']
+		self.dedup			= MessageIndex(dedup['size'], dedup['path'], dedup['timeout']) if dedup['size']>0 else None
+		profiles			= self.settings['profiles']
+		self.profiles		= ProfileCache(self._request_user_info, profiles['size'], profiles['ttl'], profiles['error_ttl'], profiles['session'], profiles['session_key'])
 		
 		# Automatically register to webhook on INIT
 		if self.settings['platform'] not in self.ALLOWED_PLATFORMS:
 			raise ValueError('Platform "%s" is not supported.' % (self.settings['platform']))
 		elif self.settings['platform'] == 'facebook':
 			if self.get_value('verify_token') is not None and self.get_value('access_token') is not None:
-				arguments						= self._http_request_get()
-				if 'hub.verify_token' in arguments and 'hub.challenge' in arguments:
-					if arguments['hub.verify_token'] == self.get_value('verify_token'):
-						print(arguments['hub.challenge'])
+				challenge	= self.verify(self._http_request_get())
+				if challenge is not None:
+					print(challenge)
+	
+	### last sender and recipient are kept per thread, so concurrent requests of server apps don't mix up replies
+	@property
+	def last_sender(self):
+		return getattr(self._local, 'last_sender', {})
+	
+	@last_sender.setter
+	def last_sender(self,sender):
+		self._local.last_sender		= sender
+	
+	@property
+	def last_recipient(self):
+		return getattr(self._local, 'last_recipient', {})
+	
+	@last_recipient.setter
+	def last_recipient(self,recipient):
+		self._local.last_recipient	= recipient
+	
+	### answer to facebook's webhook verification, returns None if the request is not a valid verification
+	def verify(self,arguments={}):
+		if self.is_platform('facebook') and self.get_value('verify_token') is not None:
+			if 'hub.verify_token' in arguments and 'hub.challenge' in arguments:
+				if arguments['hub.verify_token'] == self.get_value('verify_token'):
+					return arguments['hub.challenge']
+		return None
 	
 	def is_platform(self,compare):
 		if compare:
@@ -74,112 +221,126 @@ class Messaging:
 	def get_value(self,variable):
 		return self.settings[self.settings['platform']][variable]
 		
+	### shared HTTP session (created on first use, safe to use from multiple threads)
+	def _http(self):
+		if self.http is None:
+			with self._http_lock:
+				if self.http is None:
+					session		= requests.Session()
+					adapter		= HTTPAdapter(pool_connections=self.settings['http']['pool_connections'], pool_maxsize=self.settings['http']['pool_maxsize'], max_retries=self.settings['http']['max_retries'], pool_block=self.settings['http']['pool_block'])
+					session.mount('https://', adapter)
+					session.mount('http://', adapter)
+					if not self.settings['http']['keep_alive']:
+						session.headers['Connection']	= 'close'
+					self.http	= session
+		return self.http
+	
+	### thread pool running blocking HTTP calls for the async API
+	def _async_executor(self):
+		if self._executor is None:
+			with self._http_lock:
+				if self._executor is None:
+					self._executor	= concurrent.futures.ThreadPoolExecutor(max_workers=self.settings['async']['concurrency'], thread_name_prefix='phemia')
+		return self._executor
+	
+	### outbound queue (created on first use)
+	def _send_queue(self):
+		if self.queue is None:
+			with self._http_lock:
+				if self.queue is None:
+					self.queue	= SendQueue(self,self.settings['queue'])
+		return self.queue
+	
+	### durable outbox (created on first use)
+	def _outbox(self):
+		if self.outbox is None:
+			with self._http_lock:
+				if self.outbox is None:
+					self.outbox	= Outbox(self.settings['outbox']['path'])
+		return self.outbox
+	
+	### deliver messages stored in the outbox, returns the number of sent, retried and failed messages
+	def drain_outbox(self,limit=None):
+		return self._outbox().drain(self,limit)
+	
+	### wait for queued messages to be sent
+	def flush(self,timeout=None):
+		if self.queue is not None:
+			return self.queue.join(timeout)
+		return True
+	
+	### close pooled connections (queued messages are sent first)
+	def close(self):
+		if self.queue is not None:
+			self.queue.close()
+			self.queue	= None
+		if self.logger is not None:
+			self.logger.close()
+		with self._http_lock:
+			if self._executor is not None:
+				self._executor.shutdown(wait=True)
+				self._executor	= None
+			if self.http is not None:
+				self.http.close()
+				self.http	= None
+	
+	### add a record to the log (nothing happens without log_file), the payload is truncated to log.payload_length
+	def log(self,message,payload=None,level='error',**fields):
+		if self.logger is not None:
+			return self.logger.log(message,payload,level,**fields)
+		return False
+	
 	def log_txt(self,text):
-		if self.settings['log_file']:
-			with open(self.settings['log_file'], 'a') as out:
-				out.write(str(text) + '\n')
+		return self.log(str(text).rstrip('\n'))
 		
 	### read HTTP GET vars based on environment
 	def _http_request_get(self):
-		# TODO: implement for Python server apps
-		get 	= urllib.parse.parse_qs(os.getenv('QUERY_STRING'), encoding='utf-8')
-		data	= {}
-		for key, value in get.items():
-			data[key]=get[key][0]
-		return data	
+		# NOTE: server apps use wsgi_app() / asgi_app() instead
+		return parse_query(os.getenv('QUERY_STRING'))
 	
 	### read HTTP POST JSON vars based on environment
 	def _http_request_post(self):
 		# NOTE: can only be read once
-		# TODO: implement for Python server apps
-		return json.load(sys.stdin, encoding='utf-8')
-		#return json.loads(io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8').read())
+		# NOTE: server apps use wsgi_app() / asgi_app() instead
+		with _stage_timer(self.metrics,'parse'):
+			return json.load(sys.stdin.buffer)
+	
+	### convert every message of the current (CGI) request while it is being read
+	def receive_stream(self):
+		return self.translate_stream(sys.stdin.buffer)
 	
 	### convert received message to a simple dict
 	def receive(self):
 		data		= self._http_request_post()
 		return self.translate(data)
+	
+	### convert every message of a (batched) webhook call to simple dicts
+	def receive_all(self):
+		data		= self._http_request_post()
+		return self.translate_all(data)
 		
 	def translate(self,data):
+		if self.is_platform('facebook'):
+			event		= {}
+			try:
+				event		= data['entry'][0]['messaging'][0]
+				if self._filters is not None and self._filter_facebook(event):
+					event		= {}
+			except (KeyError, IndexError, TypeError) as e:
+				if 'entry' in data and data['entry'] and 'messaging' in data['entry'][0]:
+					self.log("Unexpected data", data, error=repr(e))
+			message		= self._translate_facebook(event,data)
+			if self._drop_duplicates() and message['other'].get('duplicate'):
+				return self._translate_facebook({},data)
+			return message
+		
 		sender		= {"id":None}
 		recipient	= {"id":None}
 		text		= None
 		attachment	= []
 		other		= {}
 		
-		if self.is_platform('facebook'):
-			if 'entry' in data and data['entry'] and 'messaging' in data['entry'][0]:
-				try:
-					sender['id']		= data['entry'][0]['messaging'][0]['sender']['id']
-					recipient['id']		= data['entry'][0]['messaging'][0]['recipient']['id']
-					
-					if 'timestamp' in data['entry'][0]['messaging'][0]:
-						other['timestamp']	= data['entry'][0]['messaging'][0]['timestamp']
-					if 'delivery' in data['entry'][0]['messaging'][0]:
-						if 'watermark' in data['entry'][0]['messaging'][0]['delivery']:
-							other['delivery']	= data['entry'][0]['messaging'][0]['delivery']['watermark']
-						if 'mids' in data['entry'][0]['messaging'][0]['delivery']:
-							other['mids']		= data['entry'][0]['messaging'][0]['delivery']['watermark']
-					if 'read' in data['entry'][0]['messaging'][0] and 'watermark' in data['entry'][0]['messaging'][0]['read']:
-						other['read']		= data['entry'][0]['messaging'][0]['read']['watermark']
-					
-					if 'postback' in data['entry'][0]['messaging'][0]:
-						text 				= data['entry'][0]['messaging'][0]['postback']['payload']
-						other['is_postback']= True
-					
-					if 'message' in data['entry'][0]['messaging'][0]:
-						if 'text' in data['entry'][0]['messaging'][0]['message']:
-							text 				= data['entry'][0]['messaging'][0]['message']['text']
-						else:
-							text				= ""
-						
-						if 'is_echo' in data['entry'][0]['messaging'][0]['message']:
-							other['is_echo']	=  data['entry'][0]['messaging'][0]['message']['is_echo']
-						if 'mid' in data['entry'][0]['messaging'][0]['message']:
-							other['mids']		= [data['entry'][0]['messaging'][0]['message']['mid']]
-						
-						if 'attachments' in data['entry'][0]['messaging'][0]['message']:
-							for item in data['entry'][0]['messaging'][0]['message']['attachments']:
-								if item and 'payload' in item:									
-									tmp					= {
-										"url"		: None,
-										"type"		: item['type'],
-										"reusable"	: None,
-										"title"		: None,
-										"description": None,
-										"sticker"	: None,
-										"latitude"	: None,
-										"longitude"	: None,
-										"buttons"	: []
-									}
-									if item['payload']:
-										if 'url' in item['payload']:
-											tmp['url']		= item['payload']['url']
-										if 'title' in item['payload']:
-											tmp['title']	= item['payload']['title']
-										if 'subtitle' in item['payload']:
-											tmp['description']= item['payload']['subtitle']
-										if 'sticker_id' in item['payload']:
-											tmp['sticker']	= item['payload']['sticker_id']
-										if 'coordinates' in item['payload']:
-											tmp['latitude']	= item['payload']['coordinates']['lat']
-											tmp['longitude']= item['payload']['coordinates']['long']
-										if 'is_reusable' in item['payload']:
-											tmp['reusable']= item['payload']['is_reusable']
-									else:
-										# undocumented fallback for URL attachments
-										if 'url' in item:
-											tmp['url']		= item['url']
-										if 'title' in item:
-											tmp['title']	= item['title']
-										if 'subtitle' in item:
-											tmp['description']= item['subtitle']
-
-									attachment.append(tmp)
-				except Exception as e:
-					self.log_txt("Unexpected data ' {0} ': {1}\n".format(json.dumps(data), repr(e)))
-		
-		elif self.is_platform('raw'):
+		if self.is_platform('raw'):
 			# TODO: check if allowed sender's os.environ.get('REMOTE_ADDR')/os.environ.get('HTTP_REFERER')/os.environ.get('HTTP_USER_AGENT') are allowed
 			try:
 				sender 		= deep_dict_merge(sender,data['sender'])
@@ -198,116 +359,323 @@ class Messaging:
 							attachment.append(item_fix)
 				if 'other' in data:
 					other	= data['other']				
-			except:
-				self.log_txt("Unexpected data ' {0} ': {1}\n".format(json.dumps(data), str(e)))
+			except Exception as e:
+				self.log("Unexpected data", data, error=repr(e))
 			
 		self.last_sender	= sender
 		self.last_recipient	= recipient
 
+		return self._message(sender,recipient,text,attachment,other,data)
+	
+	### generator yielding every message of every entry (facebook batches events under load)
+	def translate_all(self,data):
+		if self.is_platform('facebook'):
+			drop		= self._drop_duplicates()
+			filters		= self._filters
+			if 'entry' in data and data['entry']:
+				for entry in data['entry']:
+					if entry and 'messaging' in entry and entry['messaging']:
+						for event in entry['messaging']:
+							if filters is not None and self._filter_facebook(event):
+								continue
+							message		= self._translate_facebook(event,data)
+							if drop and message['other'].get('duplicate'):
+								continue
+							yield message
+		else:
+			yield self.translate(data)
+	
+	### generator reading the webhook JSON from a binary stream: facebook events are converted as soon as they are read,
+	### only one event is kept in memory at a time (message['raw'] is the event instead of the whole call)
+	def translate_stream(self,stream,chunk_size=65536):
+		if self.is_platform('facebook'):
+			try:
+				drop		= self._drop_duplicates()
+				filters		= self._filters
+				events		= iter_facebook_events(JSONStream(stream,chunk_size))
+				if self.metrics is not None:
+					events	= self.metrics.iterate('parse',events)
+				for event in events:
+					if filters is not None and self._filter_facebook(event):
+						continue
+					message		= self._translate_facebook(event,event)
+					if drop and message['other'].get('duplicate'):
+						continue
+					yield message
+			except ValueError as e:
+				self.log("Unexpected data", error=repr(e))
+				raise
+		else:
+			with _stage_timer(self.metrics,'parse'):
+				data	= json.load(stream)
+			yield from self.translate_all(data)
+	
+	### (kinds, senders, recipients, watermarks) checked by _filter_facebook, None if nothing is filtered
+	def _compile_filters(self,filters):
+		for kind in filters['kinds']:
+			if kind not in Dispatcher.EVENT_KINDS:
+				raise ValueError('Event kind "%s" is not supported.' % (kind))
+		if not (filters['kinds'] or filters['senders'] or filters['recipients'] or filters['watermarks']):
+			return None
+		return (frozenset(filters['kinds']), frozenset(str(id) for id in filters['senders']), frozenset(str(id) for id in filters['recipients']), filters['watermarks'] and filters['max_watermarks'])
+	
+	### True for raw facebook events that are skipped (receipts are added to the watermarks if enabled)
+	def _filter_facebook(self,event):
+		kinds, senders, recipients, watermarks	= self._filters
+		try:
+			if senders and str(event['sender']['id']) in senders:
+				return True
+			if recipients and str(event['recipient']['id']) not in recipients:
+				return True
+		except (KeyError, TypeError):
+			# malformed events are left to the translation (which logs them)
+			return False
+		if kinds or watermarks:
+			kind	= facebook_event_kind(event)
+			if watermarks and kind in ('delivery','read') and isinstance(event[kind], dict):
+				if self._add_watermark(event['sender']['id'], kind, event[kind].get('watermark'), watermarks):
+					return True
+			return kind in kinds
+		return False
+	
+	### False if the receipt is not collected (no numeric watermark or too many senders), it is translated then
+	def _add_watermark(self,sender,kind,watermark,limit):
+		if not isinstance(watermark, (int, float)) or isinstance(watermark, bool):
+			return False
+		with self._watermarks_lock:
+			marks	= self.watermarks.get(sender)
+			if marks is None:
+				if len(self.watermarks)>=limit:
+					return False
+				marks	= self.watermarks[sender]	= {}
+			if watermark>marks.get(kind, 0):
+				marks[kind]	= watermark
+		return True
+	
+	### collected watermarks (cleared), e.g. to store them once per webhook call instead of once per receipt
+	### long running servers (WSGI) must call it after every webhook, watermarks are kept until then
+	def pop_watermarks(self):
+		with self._watermarks_lock:
+			watermarks, self.watermarks	= self.watermarks, {}
+		return watermarks
+	
+	def _drop_duplicates(self):
+		return self.dedup is not None and self.settings['dedup']['drop']
+	
+	### convert a single facebook messaging event (walks the event once, fields are copied as described by FACEBOOK_EVENT_FIELDS)
+	def _translate_facebook(self,event,data):
+		metrics		= self.metrics
+		if metrics is not None:
+			start	= time.perf_counter()
+		sender		= {"id":None}
+		recipient	= {"id":None}
+		text		= None
+		attachment	= []
+		other		= {}
+		
+		if event:
+			try:
+				sender['id']		= event['sender']['id']
+				recipient['id']		= event['recipient']['id']
+				
+				table		= self.FACEBOOK_EVENT_FIELDS
+				for section in event:
+					if section in table:
+						fields	= table[section]
+						source	= event[section]
+						if fields is None:
+							other[section]	= source
+						elif source:
+							for field, key in fields:
+								if field in source:
+									other[key]	= source[field]
+				
+				postback	= event.get('postback')
+				if postback is not None:
+					text 				= postback['payload']
+					other['is_postback']= True
+				
+				message		= event.get('message')
+				if message is not None:
+					text		= message.get('text', "")
+					if 'mid' in message:
+						mid				= message['mid']
+						other['mids']	= [mid]
+						if self.dedup is not None and self.dedup.add(mid):
+							other['duplicate']	= True
+					if 'attachments' in message:
+						for item in message['attachments']:
+							if item and 'payload' in item:
+								attachment.append(self._translate_facebook_attachment(item))
+			except Exception as e:
+				self.log("Unexpected data", event, error=repr(e))
+		
+		local				= self._local
+		local.last_sender	= sender
+		local.last_recipient= recipient
+
+		message		= self._message(sender,recipient,text,attachment,other,data)
+		if metrics is not None:
+			metrics.observe('translate', time.perf_counter()-start)
+		return message
+	
+	### received message as a dict or as a Message object (see message_objects and keep_raw)
+	def _message(self,sender,recipient,text,attachment,other,raw):
+		if not self.settings['keep_raw']:
+			raw		= None
+		if self.settings['message_objects']:
+			return Message(sender=sender, recipient=recipient, text=text, attachment=[Attachment(item) for item in attachment], other=other, raw=raw)
 		return {
 			"sender"		: sender,
 			"recipient"		: recipient,
 			"text"			: text,
 			"attachment"	: attachment,
 			"other"			: other,
-			"raw"			: data
+			"raw"			: raw
+		}
+	
+	def _translate_facebook_attachment(self,item):
+		payload		= item['payload']
+		if payload:
+			coordinates	= payload.get('coordinates')
+			return {
+				"url"		: payload.get('url'),
+				"type"		: item['type'],
+				"reusable"	: payload.get('is_reusable'),
+				"title"		: payload.get('title'),
+				"description": payload.get('subtitle'),
+				"sticker"	: payload.get('sticker_id'),
+				"latitude"	: coordinates['lat'] if coordinates else None,
+				"longitude"	: coordinates['long'] if coordinates else None,
+				"buttons"	: []
+			}
+		# undocumented fallback for URL attachments
+		return {
+			"url"		: item.get('url'),
+			"type"		: item['type'],
+			"reusable"	: None,
+			"title"		: item.get('title'),
+			"description": item.get('subtitle'),
+			"sticker"	: None,
+			"latitude"	: None,
+			"longitude"	: None,
+			"buttons"	: []
 		}
 	
 	### send message
 	def send(self,message={}):
-		if self.is_platform('facebook'):
-			response	= {
-				"recipient"		: {"id"		: message['recipient']['id']},
-				"message"		: {}
+		if self.settings['outbox']['path']:
+			compiled	= self.compile(message)
+			return {
+				"request"	: self._request_info(None),
+				"sender"	: {},
+				"recipient"	: compiled['recipient'],
+				"other"		: {"outbox"	: self._outbox().put(compiled)},
+				"raw"		: {},
+				"error"		: {}
 			}
-			# text
-			if 'text' in message:
-				response['message']['text']			= message['text'][:self.ALLOWED_FACEBOOK_MESSAGE_LENGTH]
-			# attachment
-			if 'attachment' in message:
-				# send ONE file / image
-				if len(message['attachment'])==1 and 'url' in message['attachment'][0] and message['attachment'][0]['url']:
-					if 'type' not in message['attachment'][0] or message['attachment'][0]['type'] not in self.ALLOWED_ATTACHMENTS:
-						message['attachment'][0]['type']	= get_attachment_type(message['attachment'][0]['url'])
-					if 'cache' in message['attachment'][0] and message['attachment'][0]['cache']:
-						if message['attachment'][0]['cache']>int(time.time()):
-							reusable	= True
-						else:
-							reusable	= False
-					else:
-						reusable	= False
-					
-					if 'text' in message and message['text']:
-						if 'title' not in message['attachment'][0]:
-							message['attachment'][0]['title']= message['text'][:self.ALLOWED_FACEBOOK_TITLE_LENGTH]
-						elif 'description' not in message['attachment'][0]:
-							message['attachment'][0]['description']= message['text'][:self.ALLOWED_FACEBOOK_SUBTITLE_LENGTH]
-						## DELETE
-						response['message'].pop('text')	# facebook won't send attachments with text
-				
-					# send ONE file / image as a simple attachment WITHOUT text	or buttons		
-					if (('title' not in message['attachment'][0] or not message['attachment'][0]['title']) and ('description' not in message['attachment'][0] or not message['attachment'][0]['description']) and ('buttons' not in message['attachment'][0] or not message['attachment'][0]['buttons'])) or message['attachment'][0]['type'] != 'image':
-						response['message']['attachment']	= {
-							"type"		: message['attachment'][0]['type'],
-							"payload"	: {
-								"url"		: message['attachment'][0]['url'],
-								"is_reusable":reusable
-							}
-						}
-					# send ONE image WITH text and/or buttons	
-					elif message['attachment'][0]['type'] == 'image':
-						if 'title' not in message['attachment'][0]:
-							message['attachment'][0]['title']	= message['attachment'][0]['url']
-						if 'description' not in message['attachment'][0]:
-							message['attachment'][0]['description']= ""
-						if 'buttons' in message['attachment'][0]:
-							buttons								= self._generate_facebook_buttons(message['attachment'][0]['buttons'])[:self.ALLOWED_FACEBOOK_BUTTONS_LENGTH]
-						else:
-							buttons								= None
-						
-						response['message']['attachment']	= {
-							"type"		: "template",
-							"payload"	:{
-								"template_type"	:"generic",
-								"elements"		:[
-								   {
-									"title"			: message['attachment'][0]['title'],
-									"image_url"		: message['attachment'][0]['url'],
-									"subtitle"		: message['attachment'][0]['description'],
-									"default_action": {
-									  "type"			: "web_url",
-									  "url"				: message['attachment'][0]['url'],
-									  "messenger_extensions": True,
-									  "webview_height_ratio": "full",	# compact|tall|full
-									  "fallback_url"	: message['attachment'][0]['url']
-									},
-									"buttons"	: buttons     
-								  }
-								]
-							}
-						}
-				# send text with buttons
-				elif len(message['attachment'])==1 and ('url' not in message['attachment'][0] or not message['attachment'][0]['url']) and ('type' not in message['attachment'][0] or message['attachment'][0]['type']=='none'):
-					if 'buttons' in message['attachment'][0]:
-						response['message']['quick_replies']= self._generate_facebook_buttons(message['attachment'][0]['buttons'], 'quick_reply')					
-				
-			# other
-			if 'other' in message:
-				# sender action such as typing_on, typing_off, mark_seen			
-				if 'action' in message['other']:
-					if not response['message']:	# facebook won't send actions with attachments or text
-						response['sender_action']			= message['other']['action']
-						response['message']					= None
-				# documented on facebook but does not work
-				if 'notification' in message['other']:
-					response['notification_type']		= message['other']['notification']
-			
-			data_json	= {}
-			recipient	= {}
-			other		= {}
+		if self.settings['queue']['enabled']:
+			return self.enqueue(self.compile(message))
+		return self.send_compiled(self.compile(message))
+	
+	### queue a payload created by compile() for background delivery
+	def enqueue(self,compiled):
+		self._send_queue().put(compiled)
+		return {
+			"request"	: self._request_info(None),
+			"sender"	: {},
+			"recipient"	: compiled['recipient'],
+			"other"		: {"queued"	: True},
+			"raw"		: {},
+			"error"		: {}
+		}
+	
+	### check if sending a message should be tried again based on the result of send_compiled()
+	def should_retry(self,result):
+		status_code	= result['request']['status_code']
+		if status_code is not None and (status_code==429 or status_code>=500):
+			return True
+		if result['error']:
+			if 'type' in result['error'] and result['error']['type']=='PhemiaRequestError':
+				return True
+			if result['error'].get('is_transient'):
+				return True
+			if result['error'].get('platform')=='facebook' and result['error'].get('code') in self.FACEBOOK_RETRY_ERROR_CODES:
+				return True
+		return False
+	
+	### build the platform payload of a message without sending it, the result can be reused by any transport
+	### NOTE: payloads of identical messages are shared through the cache, treat them as read-only
+	def compile(self,message={}):
+		metrics	= self.metrics
+		if metrics is not None:
+			start	= time.perf_counter()
+		key		= self._compile_key(message)
+		cached	= self.cache.get(key) if key is not None else None
+		if cached is None:
+			if self.is_platform('facebook'):
+				payload	= self._generate_facebook_message(message)
+			else:
+				payload	= {}
+				for item in ('recipient','sender','text','attachment','other'):
+					if item in message:
+						payload[item]	= message[item]
+			# everything but the recipient is serialized once and reused for other recipients
+			payload.pop('recipient', None)
+			cached	= (payload, json.dumps(payload, default=Model.to_json)[1:-1])
+			if key is not None:
+				self.cache.set(key,cached)
+		
+		payload, body	= cached
+		if 'recipient' in message:
+			if self.is_platform('facebook'):
+				recipient	= {"id"		: message['recipient']['id']}
+			else:
+				recipient	= message['recipient']
+			payload		= dict(recipient=recipient, **payload)
+			if body:
+				body	= '"recipient": ' + json.dumps(recipient, default=Model.to_json) + ', ' + body
+			else:
+				body	= '"recipient": ' + json.dumps(recipient, default=Model.to_json)
+		elif self.is_platform('facebook'):
+			raise KeyError('recipient')
+		
+		compiled	= {
+			"platform"	: self.settings['platform'],
+			"recipient"	: message['recipient'] if 'recipient' in message else {},
+			"sender"	: message['sender'] if 'sender' in message else {},
+			"payload"	: payload,
+			"body"		: ('{' + body + '}').encode('utf-8')
+		}
+		if metrics is not None:
+			metrics.observe('compile', time.perf_counter()-start)
+		return compiled
+	
+	### recipient independent cache key of a message (None if it should not be cached)
+	def _compile_key(self,message):
+		if not self.cache.size:
+			return None
+		if 'attachment' in message:
+			for item in message['attachment']:
+				if 'cache' in item:		# reusable flag depends on the current time
+					return None
+		key		= [self.settings['platform']]
+		for item in ('sender','text','attachment','other'):
+			if item in message:
+				key.append((item, message[item]))
+		try:
+			return json.dumps(key, sort_keys=True, default=Model.to_json)
+		except (TypeError, ValueError):
+			return None
+	
+	### send a payload created by compile()
+	def send_compiled(self,compiled):
+		if compiled['platform']=='facebook':
+			data		= None
 			error		= {}
 			try:
-				data	= requests.post("https://graph.facebook.com/v2.6/me/messages?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(response), timeout=self.get_value('timeout'))
+				with _stage_timer(self.metrics,'http'):
+					data	= self._http().post(self.FACEBOOK_GRAPH_URL + "me/messages?access_token=" + self.settings['facebook']['access_token'], headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=compiled['body'], timeout=self.settings['facebook']['timeout'])
 			#except requests.exceptions.Timeout as e:
 			#except requests.exceptions.TooManyRedirects as e:
 			#except requests.exceptions.HTTPError as e:
@@ -317,137 +685,298 @@ class Messaging:
 				error['message']	= str(e)
 			
 			try:
-				data_json	= data.json()
-				if 'recipient_id' in data_json:
-					recipient		= {"id"		: data_json['recipient_id']}
-				else:
-					recipient		= message['recipient']
-				if 'message_id' in data_json:
-					other['mids']	= [data_json['message_id']]
-			except:
-				error['platform']	= "python"
-				error['type']		= "PhemiaRequestError"
-				error['message']	= "Failed to convert received data to JSON"
-				data_json	= {}
-			
-			if 'error' in data_json:
-				error				= data_json['error']
-				error['platform']	= "facebook"				
-			
-			try:
-				request	= {
-					"status_code"	: data.status_code,
-					"headers"		: dict(data.headers),
-					"encoding"		: data.encoding
-				}
+				with _stage_timer(self.metrics,'response'):
+					data_json	= data.json()
 			except:
-				if data:
-					request	= {
-						"status_code"	: data.status_code,
-						"headers"		: None,
-						"encoding"		: None
-					}
-				else:
-					request	= {
-						"status_code"	: None,
-						"headers"		: None,
-						"encoding"		: None
-					}
-					
-			return {
-				"request"	: request,
-				"sender"	: {},
-				"recipient"	: recipient,
-				"other"		: other,
-				"raw"		: data_json,
-				"error"		: error
-			}
+				data_json	= None
 			
-		elif self.is_platform('raw'):
-			response	= {}
-			for item in ('recipient','sender','text','attachment','other'):
-				if item in message:
-					response[item]	= message[item]
+			return self._facebook_result(compiled,data_json,self._request_info(data),error)
 			
+		elif compiled['platform']=='raw':
+			settings	= self.settings['raw']
+			response	= compiled['payload']
+			data		= None
 			data_json	= {}
 			sender		= {}
 			recipient	= {}
 			other		= {}
 			error		= {}
 			try:
-				if self.get_value('print'):
-					if not self.get_value('print_text_only') or (self.get_value('print_text_only') and 'text' in response and response['text']):
-						if self.get_value('jsonp'):
-							print(str(get_value('jsonp'))+'('+json.dumps(response)+');')
+				if settings['print']:
+					if not settings['print_text_only'] or (settings['print_text_only'] and 'text' in response and response['text']):
+						if settings['jsonp']:
+							print(str(settings['jsonp'])+'('+compiled['body'].decode('utf-8')+');')
 						else:
-							print(json.dumps(response))
+							print(compiled['body'].decode('utf-8'))
 			except:
 				error['platform']	= "python"
 				error['type']		= "PhemiaOutputError"
 				error['message']	= "Could not print response data to STDOUT."
 			try:
-				if self.get_value('server'):
-					data	= requests.post(server, headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(response), timeout=self.get_value('timeout'))	
-					if 'sender' in data:
-						sender		= data['sender']
-					elif 'sender' in message:
-						sender		= message['sender']
-					if 'recipient' in data:
-						recipient	= data['recipient']
-					elif 'recipient' in message:
-						recipient	= message['recipient']
-					if 'other' in data:
-						other		= data['other']
-				else:
-					data	= {}
+				if settings['server']:
+					with _stage_timer(self.metrics,'http'):
+						data	= self._http().post(settings['server'], headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=compiled['body'], timeout=settings['timeout'])
+					sender		= compiled['sender']
+					recipient	= compiled['recipient']
 			except requests.exceptions.RequestException as e:
 				error['platform']	= "python"
 				error['type']		= "PhemiaRequestError"
 				error['message']	= str(e)
 			try:
-				if data:
-					data_json	= data.json()
-				else:
-					data_json	= {}
+				if data is not None:
+					with _stage_timer(self.metrics,'response'):
+						data_json	= data.json()
 			except:
 				error['platform']	= "python"
 				error['type']		= "PhemiaRequestError"
 				error['message']	= "Failed to convert received data to JSON"
 				data_json	= {}
 			
-			if 'error' in data_json:
-				error				= data_json['error']
-				error['platform']	= "raw"				
-			
-			try:
-				request	= {
-					"status_code"	: data.status_code,
-					"headers"		: dict(data.headers),
-					"encoding"		: data.encoding
-				}
-			except:
-				if data:
-					request	= {
-						"status_code"	: data.status_code,
-						"headers"		: None,
-						"encoding"		: None
-					}
-				else:
-					request	= {
-						"status_code"	: None,
-						"headers"		: None,
-						"encoding"		: None
-					}
+			if isinstance(data_json, dict):
+				if 'sender' in data_json:
+					sender		= data_json['sender']
+				if 'recipient' in data_json:
+					recipient	= data_json['recipient']
+				if 'other' in data_json:
+					other		= data_json['other']
+				if 'error' in data_json:
+					error				= data_json['error']
+					error['platform']	= "raw"
 			
-			return {
-				"request"	: request,
+			result	= {
+				"request"	: self._request_info(data),
 				"sender"	: sender,
 				"recipient"	: recipient,
 				"other"		: other,
 				"raw"		: data_json,
 				"error"		: error
 			}
+			if self.metrics is not None:
+				self.metrics.count_result('raw',result)
+			return result
+		raise ValueError('Platform "%s" is not supported.' % (compiled['platform']))
+	
+	### build the facebook send API payload of a message (message is not modified)
+	def _generate_facebook_message(self,message):
+		response	= {
+			"recipient"		: {"id"		: message['recipient']['id']},
+			"message"		: {}
+		}
+		# text
+		if 'text' in message:
+			response['message']['text']			= message['text'][:self.ALLOWED_FACEBOOK_MESSAGE_LENGTH]
+		# attachment
+		if 'attachment' in message:
+			item	= dict(message['attachment'][0]) if len(message['attachment'])==1 else {}	# work on a copy, the message is left untouched
+			# send ONE file / image
+			if len(message['attachment'])==1 and 'url' in item and item['url']:
+				if 'type' not in item or item['type'] not in self.ALLOWED_ATTACHMENTS:
+					item['type']	= get_attachment_type(item['url'])
+				if 'cache' in item and item['cache']:
+					if item['cache']>int(time.time()):
+						reusable	= True
+					else:
+						reusable	= False
+				else:
+					reusable	= False
+				
+				if 'text' in message and message['text']:
+					if 'title' not in item:
+						item['title']= message['text'][:self.ALLOWED_FACEBOOK_TITLE_LENGTH]
+					elif 'description' not in item:
+						item['description']= message['text'][:self.ALLOWED_FACEBOOK_SUBTITLE_LENGTH]
+					## DELETE
+					response['message'].pop('text')	# facebook won't send attachments with text
+			
+				# send ONE file / image as a simple attachment WITHOUT text	or buttons		
+				if (('title' not in item or not item['title']) and ('description' not in item or not item['description']) and ('buttons' not in item or not item['buttons'])) or item['type'] != 'image':
+					response['message']['attachment']	= {
+						"type"		: item['type'],
+						"payload"	: {
+							"url"		: item['url'],
+							"is_reusable":reusable
+						}
+					}
+				# send ONE image WITH text and/or buttons	
+				elif item['type'] == 'image':
+					if 'title' not in item:
+						item['title']	= item['url']
+					if 'description' not in item:
+						item['description']= ""
+					if 'buttons' in item:
+						buttons								= self._generate_facebook_buttons(item['buttons'])[:self.ALLOWED_FACEBOOK_BUTTONS_LENGTH]
+					else:
+						buttons								= None
+					
+					response['message']['attachment']	= {
+						"type"		: "template",
+						"payload"	:{
+							"template_type"	:"generic",
+							"elements"		:[
+							   {
+								"title"			: item['title'],
+								"image_url"		: item['url'],
+								"subtitle"		: item['description'],
+								"default_action": {
+								  "type"			: "web_url",
+								  "url"				: item['url'],
+								  "messenger_extensions": True,
+								  "webview_height_ratio": "full",	# compact|tall|full
+								  "fallback_url"	: item['url']
+								},
+								"buttons"	: buttons     
+							  }
+							]
+						}
+					}
+			# send text with buttons
+			elif len(message['attachment'])==1 and ('url' not in item or not item['url']) and ('type' not in item or item['type']=='none'):
+				if 'buttons' in item:
+					response['message']['quick_replies']= self._generate_facebook_buttons(item['buttons'], 'quick_reply')					
+			
+		# other
+		if 'other' in message:
+			# sender action such as typing_on, typing_off, mark_seen			
+			if 'action' in message['other']:
+				if not response['message']:	# facebook won't send actions with attachments or text
+					response['sender_action']			= message['other']['action']
+					response['message']					= None
+			# documented on facebook but does not work
+			if 'notification' in message['other']:
+				response['notification_type']		= message['other']['notification']
+		return response
+	
+	### summary of a requests response object
+	def _request_info(self,data):
+		try:
+			return {
+				"status_code"	: data.status_code,
+				"headers"		: dict(data.headers),
+				"encoding"		: data.encoding
+			}
+		except:
+			if data is not None:
+				return {
+					"status_code"	: data.status_code,
+					"headers"		: None,
+					"encoding"		: None
+				}
+			return {
+				"status_code"	: None,
+				"headers"		: None,
+				"encoding"		: None
+			}
+	
+	### convert a facebook send API response (None if not JSON) to the dict returned by send()
+	def _facebook_result(self,message,data_json,request,error={}):
+		recipient	= {}
+		other		= {}
+		error		= dict(error)
+		if isinstance(data_json, dict):
+			if 'recipient_id' in data_json:
+				recipient		= {"id"		: data_json['recipient_id']}
+			else:
+				recipient		= message['recipient']
+			if 'message_id' in data_json:
+				other['mids']	= [data_json['message_id']]
+		else:
+			if not error:
+				error['platform']	= "python"
+				error['type']		= "PhemiaRequestError"
+				error['message']	= "Failed to convert received data to JSON"
+			data_json	= {}
+		
+		if 'error' in data_json:
+			error				= data_json['error']
+			error['platform']	= "facebook"
+		
+		result	= {
+			"request"	: request,
+			"sender"	: {},
+			"recipient"	: recipient,
+			"other"		: other,
+			"raw"		: data_json,
+			"error"		: error
+		}
+		if self.metrics is not None:
+			self.metrics.count_result('facebook',result)
+		return result
+	
+	### send several messages, packed into graph API batch requests on facebook
+	def send_many(self,messages=[]):
+		if not self.is_platform('facebook'):
+			return [self.send(message) for message in messages]
+		
+		results	= []
+		for start in range(0, len(messages), self.ALLOWED_FACEBOOK_BATCH_LENGTH):
+			chunk	= messages[start:start+self.ALLOWED_FACEBOOK_BATCH_LENGTH]
+			batch	= []
+			for message in chunk:
+				response	= self.compile(message)['payload']
+				body		= {}
+				for key, value in response.items():
+					if value is not None:
+						body[key]	= value if isinstance(value, str) else json.dumps(value)
+				batch.append({
+					"method"		: "POST",
+					"relative_url"	: self.FACEBOOK_GRAPH_VERSION + "/me/messages",
+					"body"			: urllib.parse.urlencode(body)
+				})
+			
+			data		= None
+			data_json	= None
+			error		= {}
+			try:
+				with _stage_timer(self.metrics,'http'):
+					data	= self._http().post(self.FACEBOOK_GRAPH_URL_BASE, data={"access_token": self.get_value('access_token'), "batch": json.dumps(batch)}, headers={'Accept': 'text/plain'}, timeout=self.get_value('timeout'))
+				with _stage_timer(self.metrics,'response'):
+					data_json	= data.json()
+			except requests.exceptions.RequestException as e:
+				error['platform']	= "python"
+				error['type']		= "PhemiaRequestError"
+				error['message']	= str(e)
+			except ValueError:
+				error['platform']	= "python"
+				error['type']		= "PhemiaRequestError"
+				error['message']	= "Failed to convert received data to JSON"
 			
+			if not isinstance(data_json, list):
+				# the whole batch failed (network error, invalid token, server error, etc.)
+				if isinstance(data_json, dict) and 'error' in data_json:
+					error				= data_json['error']
+					error['platform']	= "facebook"
+				elif not error:
+					error['platform']	= "python"
+					error['type']		= "PhemiaRequestError"
+					error['message']	= "Unexpected response to batch request"
+				request	= self._request_info(data)
+				for message in chunk:
+					results.append(self._facebook_result(message,{},request,error))
+				continue
+			
+			for message, item in zip(chunk, data_json + [None] * (len(chunk)-len(data_json))):
+				if not item:
+					results.append(self._facebook_result(message,None,self._request_info(None),{
+						"platform"	: "facebook",
+						"type"		: "PhemiaRequestError",
+						"message"	: "No response received for batched request"
+					}))
+					continue
+				headers		= {}
+				for header in item.get('headers') or []:
+					headers[header['name']]	= header['value']
+				try:
+					item_json	= json.loads(item['body'])
+				except:
+					item_json	= None
+				request		= {
+					"status_code"	: item.get('code'),
+					"headers"		: headers,
+					"encoding"		: None
+				}
+				results.append(self._facebook_result(message,item_json,request))
+		return results
+	
 	def _generate_fallback_url(self,url):
 		if url:
 			return "{0.scheme}://{0.netloc}/".format(urllib.parse.urlsplit(url))
@@ -513,10 +1042,25 @@ class Messaging:
 			message['recipient']	= self.last_sender
 		return self.send(message)
 	
+	### send message without blocking the event loop
+	async def send_async(self,message={}):
+		loop	= asyncio.get_running_loop()
+		return await loop.run_in_executor(self._async_executor(), self.send, message)
+	
+	### send reply without blocking the event loop
+	async def reply_async(self,message={}):
+		if 'recipient' not in message:
+			message['recipient']	= self.last_sender
+		return await self.send_async(message)
+	
+	### send several messages concurrently (at most async.concurrency at once), results keep the order of messages
+	async def send_all_async(self,messages=[]):
+		return await asyncio.gather(*[self.send_async(message) for message in messages])
+	
 	def whitelist(self,action="get",domains=[]):
 		if self.is_platform('facebook'):
 			if action=="get":
-				data	= requests.get("https://graph.facebook.com/v2.6/me/thread_settings?fields=whitelisted_domains&access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, timeout=self.get_value('timeout'))
+				data	= self._http().get(self.FACEBOOK_GRAPH_URL + "me/thread_settings?fields=whitelisted_domains&access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, timeout=self.get_value('timeout'))
 			elif action in ('add','remove','set'):
 				if not domains:
 					#domains	= ['https://'+os.environ.get('HTTP_HOST')+'/']
@@ -526,7 +1070,7 @@ class Messaging:
 					"whitelisted_domains": domains,
 					"domain_action_type": "add"
 				}
-				data	= requests.post("https://graph.facebook.com/v2.6/me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
+				data	= self._http().post(self.FACEBOOK_GRAPH_URL + "me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
 			else:
 				raise ValueError('Only "get", "add" and "remove" are supported.')
 				return {}
@@ -542,7 +1086,7 @@ class Messaging:
 						"thread_state"		: "existing_thread",
 						"call_to_actions"	: self._generate_facebook_buttons(menu['attachment'][0]['buttons'],'menu')
 					}
-					data	= requests.post("https://graph.facebook.com/v2.6/me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
+					data	= self._http().post(self.FACEBOOK_GRAPH_URL + "me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
 					return data.json()
 				else:
 					raise ValueError('No attachment with buttons found.')
@@ -552,7 +1096,7 @@ class Messaging:
 					"setting_type"		: "call_to_actions",
 					"thread_state"		: "existing_thread"
 				}
-				data	= requests.delete("https://graph.facebook.com/v2.6/me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
+				data	= self._http().delete(self.FACEBOOK_GRAPH_URL + "me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
 				return data.json()
 		return {}
 
@@ -564,33 +1108,101 @@ class Messaging:
 			}
 			if payload is not None:
 				curl['call_to_actions']	= [{"payload":payload}]
-				data	= requests.post("https://graph.facebook.com/v2.6/me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
+				data	= self._http().post(self.FACEBOOK_GRAPH_URL + "me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
 			else:
-				data	= requests.delete("https://graph.facebook.com/v2.6/me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
+				data	= self._http().delete(self.FACEBOOK_GRAPH_URL + "me/thread_settings?access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, data=json.dumps(curl), timeout=self.get_value('timeout'))
 			return data.json()
 		return {}
 		
-	def get_user_info(self,user={}):
+	### profile of a user (cached, see settings['profiles']), refresh=True requests it again
+	def get_user_info(self,user={},refresh=False):
 		if self.is_platform('facebook'):
 			if user and 'id' in user:
-				data	= requests.get("https://graph.facebook.com/v2.6/"+str(user['id'])+"?fields=first_name,last_name,profile_pic,locale,timezone,gender&access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, timeout=self.get_value('timeout'))
-				return data.json()
+				return self.profiles.get(user['id'],refresh)
 		return {}
+	
+	def _request_user_info(self,id):
+		data	= self._http().get(self.FACEBOOK_GRAPH_URL + ""+str(id)+"?fields=first_name,last_name,profile_pic,locale,timezone,gender&access_token=" + self.get_value('access_token'), headers={'Content-type': 'application/json', 'Accept': 'text/plain'}, timeout=self.get_value('timeout'))
+		return data.json()
 
 class Session:
 
-	ALLOWED_PLATFORMS	= ('raw')
+	ALLOWED_PLATFORMS	= ('raw','sqlite')
+	ALLOWED_FORMATS		= ('json','marshal')
+	MARSHAL_HEADER		= b'PHM1'		# marks session files stored with marshal (followed by the format version)
 	
 	##### CONSTRUCTOR #####
 	def __init__(self,options={}):
 		default_settings	= {
 			"platform"	: "raw",				# save session as text files by default
+			"ttl"		: None,					# seconds after the last update a session expires (None never expires)
 			"raw"		: {						# saving sessions as text files containing JSON objects
 				"path"				: '',		# server to send messages to (if given)
-				"extension"			: 'txt'		# file extension
+				"extension"			: 'txt',	# file extension
+				"locking"			: True,		# lock files during read-modify-write (between threads and processes)
+				"lock_stripes"		: 64,		# number of lock files shared by the session files (ids are hashed to one of them)
+				"shards"			: 0,		# levels of hashed subdirectories (256 per level), 0 keeps every file in path
+				"format"			: 'json',	# json (text) or marshal (compact binary, only for trusted local files)
+				"migrate"			: True		# move files of the original layout (path/id.txt) to the configured one on first access
+			},
+			"sqlite"	: {						# saving sessions in a SQLite database with one row per key
+				"path"				: 'sessions.db',	# database file
+				"timeout"			: 30		# seconds to wait for locks held by other processes
+			},
+			"metrics"	: None,					# Metrics collecting read / write timings (may be shared with Messaging), None to disable
+			"cache"		: {						# keep documents in memory and write changes back later
+				"enabled"			: False,	# load a document once and write it back on flush() instead of on every change
+				"size"				: 1000,		# max. number of documents kept in memory (dirty ones are written when pushed out)
+				"flush_interval"	: None		# write changes from a background thread every N seconds (flush() / exit otherwise)
 			}
 		}
 		self.settings		= deep_dict_merge(default_settings,options)
+		self.metrics		= Metrics() if self.settings['metrics'] is True else self.settings['metrics']
+		self.cache			= None
+		self._dirty			= set()
+		self._writing		= {}				# id => changed document pushed out of the cache, waiting to be written
+		self._lock			= threading.RLock()	# guards the cache and the dirty set only, files are read and written outside of it
+		self._local			= threading.local()
+		self._stripes		= [threading.Lock() for i in range(max(self.settings['raw']['lock_stripes'],1))]
+		self._stripe_files	= {}
+		self._pid			= os.getpid()		# process the lock files were opened in, a forked worker opens its own
+		if self.settings['cache']['enabled']:
+			self.cache		= LRUCache(self.settings['cache']['size'],on_evict=self._evicted)
+			atexit.register(self.flush)
+			if self.settings['cache']['flush_interval']:
+				thread		= threading.Thread(target=self._flush_periodically, name='phemia-session-flush', daemon=True)
+				thread.start()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self,*args):
+		self.close()
+	
+	### write pending changes and close the lock files and the database connection of the current thread
+	def close(self):
+		self.flush()
+		for stripe in list(self._stripe_files):
+			with self._stripes[stripe]:
+				handle	= self._stripe_files.pop(stripe, None)
+				if handle is not None:
+					handle.close()
+		connection	= getattr(self._local, 'connection', None)
+		if connection is not None:
+			connection.close()
+			self._local.connection	= None
+	
+	### a forked worker must not share the lock files (flock locks belong to the open file) or connections of its parent
+	def _check_pid(self):
+		if self._pid==os.getpid():
+			return
+		# closing the inherited handles does not release locks of the parent, which still has them open
+		for handle in self._stripe_files.values():
+			handle.close()
+		self._stripe_files	= {}
+		self._stripes		= [threading.Lock() for i in range(len(self._stripes))]
+		self._local			= threading.local()
+		self._pid			= os.getpid()
 	
 	def is_platform(self,compare):
 		if compare:
@@ -606,98 +1218,1912 @@ class Session:
 	def get_value(self,variable):
 		return self.settings[self.settings['platform']][variable]
 			
-	def file_command(self,command,id,new_contents=None):
+	def file_name(self,id):
+		name	= id
 		if self.get_value('extension'):
 			if self.get_value('extension')[0]=='.':
-				id	+= self.get_value('extension')
+				name	+= self.get_value('extension')
 			else:
-				id	+= '.'+self.get_value('extension')
-		file	= os.path.join(self.get_value('path'), id)	
+				name	+= '.'+self.get_value('extension')
+		if self.get_value('shards'):
+			digest	= hashlib.md5(id.encode('utf-8')).hexdigest()
+			return os.path.join(self.get_value('path'), *([digest[i*2:i*2+2] for i in range(self.get_value('shards'))]+[name]))
+		return os.path.join(self.get_value('path'), name)
+	
+	### file of the session in the original layout (flat, JSON)
+	def _legacy_file_name(self,id):
+		if self.get_value('migrate'):
+			file	= os.path.join(self.get_value('path'), os.path.basename(self.file_name(id)))
+			if file!=self.file_name(id):
+				return file
+		return None
+	
+	def file_command(self,command,id,new_contents=None):
+		file	= self.file_name(id)
 		if command=='remove':
-			os.remove(file)
+			legacy	= self._legacy_file_name(id)
+			if legacy and not os.path.isfile(file):
+				os.remove(legacy)
+			else:
+				os.remove(file)
 		else:
 			if command=='get':
-				if not os.path.isfile(file):
-					data	= open(file, 'a').close()
+				data	= self._read_file(file)
+				if data is None:
+					legacy	= self._legacy_file_name(id)
+					if legacy and os.path.isfile(legacy):
+						# move to the new layout / format, another reader may be doing the same
+						with self.file_lock(id):
+							data	= self._read_file(file)
+							if data is not None:
+								return data
+							data	= self._read_file(legacy)
+							if data is not None:
+								self._write_file(file,data)
+								try:
+									os.remove(legacy)
+								except FileNotFoundError:
+									pass
+								return data
 					return {}
-				else:
-					data	= open(file, 'r').read()
-					if data:
-						return json.loads(data)
-					else:
-						return {}
+				return data
 						
 			else:
-				data	= open(file, 'w')
-				if command=='set':
-					if new_contents:
-						data.write(json.dumps(new_contents))
-					else:
-						data.write('{}')
-					data.close()
-				elif command=='clear':
-					data.write('{}')
-					data.close()
+				if command=='set' and new_contents:
+					self._write_file(file,new_contents)
+				elif command in ('set','clear'):
+					self._write_file(file,{})
 		return {}
-
+	
+	### decode a session file (format is detected from its contents), None if it does not exist
+	def _read_file(self,file):
+		try:
+			with _stage_timer(self.metrics,'session_read'), open(file, 'rb') as handle:
+				data	= handle.read()
+		except FileNotFoundError:
+			return None
+		if data.startswith(self.MARSHAL_HEADER):
+			return marshal.loads(data[len(self.MARSHAL_HEADER)+1:])
+		if data:
+			return json.loads(data.decode('utf-8'))
+		return {}
+	
+	def _encode(self,data):
+		if self.get_value('format')=='marshal':
+			return self.MARSHAL_HEADER + bytes((marshal.version,)) + marshal.dumps(data)
+		elif self.get_value('format')=='json':
+			return json.dumps(data, separators=(',',':')).encode('utf-8')
+		raise ValueError('Format "%s" is not supported.' % (self.get_value('format')))
+	
+	### write to a temporary file first, readers never see a partially written file
+	def _write_file(self,file,data):
+		with _stage_timer(self.metrics,'session_write'):
+			self._replace_file(file,self._encode(data))
+	
+	def _replace_file(self,file,contents):
+		directory	= os.path.dirname(file)
+		temp		= os.path.join(directory, '.tmp-%d-%d-%s' % (os.getpid(), threading.get_ident(), os.path.basename(file)))
+		try:
+			try:
+				handle	= os.open(temp, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o666)
+			except FileNotFoundError:
+				os.makedirs(directory, exist_ok=True)
+				handle	= os.open(temp, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o666)
+			with os.fdopen(handle, 'wb') as out:
+				out.write(contents)
+			os.replace(temp, file)
+		except:
+			if os.path.exists(temp):
+				os.remove(temp)
+			raise
+	
+	### lock a session for read-modify-write, ids share a fixed number of lock files so no extra file is kept per session
+	@contextlib.contextmanager
+	def file_lock(self,id):
+		if not self.get_value('locking'):
+			yield
+			return
+		self._check_pid()
+		stripe	= zlib.crc32(id.encode('utf-8')) % len(self._stripes)
+		held	= getattr(self._local, 'stripes', None)
+		if held is None:
+			held	= self._local.stripes	= set()
+		if stripe in held:
+			# already locked by this thread (e.g. a file migrated while it is updated)
+			yield
+			return
+		with self._stripes[stripe]:
+			held.add(stripe)
+			try:
+				if fcntl is None:
+					yield
+					return
+				if stripe not in self._stripe_files:
+					self._stripe_files[stripe]	= open(os.path.join(self.get_value('path'), '.lock-%02x' % (stripe)), 'a')
+				fcntl.flock(self._stripe_files[stripe].fileno(), fcntl.LOCK_EX)
+				try:
+					yield
+				finally:
+					fcntl.flock(self._stripe_files[stripe].fileno(), fcntl.LOCK_UN)
+			finally:
+				held.discard(stripe)
+	
+	### read a document (from memory if cached)
+	def _load(self,id):
+		if self.cache is None:
+			data	= self.file_command('get',id)
+			if self.is_expired(data):
+				return {} if self._expire(id) else self.file_command('get',id)
+			return data
+		with self._lock:
+			data	= self.cache.get(id)
+			if data is None:
+				data	= self._writing.get(id)
+				if data is not None:
+					self.cache.set(id,data)
+		if data is None:
+			data	= self.file_command('get',id)
+			with self._lock:
+				# another thread may have loaded or changed it in the meantime
+				cached	= self.cache.get(id)
+				if cached is None:
+					self.cache.set(id,data)
+				else:
+					data	= cached
+		self._write_evicted()
+		if self.is_expired(data):
+			data	= {} if self._expire(id) else self.file_command('get',id)
+			with self._lock:
+				self.cache.set(id,data)
+			self._write_evicted()
+		return data
+	
+	### check if a session document is older than the ttl
+	def is_expired(self,data):
+		if self.settings['ttl'] and data and 'last_update' in data:
+			return data['last_update']<time.time()-self.settings['ttl']
+		return False
+	
+	### remove an expired session, returns False if another process updated it in the meantime
+	def _expire(self,id):
+		if self.is_platform('raw'):
+			with self.file_lock(id):
+				data	= self.file_command('get',id)
+				if data and not self.is_expired(data):
+					return False
+				self._forget(id)
+				try:
+					self.file_command('remove',id)
+				except FileNotFoundError:
+					pass
+		elif self.is_platform('sqlite'):
+			with self._transaction() as connection:
+				row		= connection.execute('SELECT value FROM sessions WHERE id=? AND key=\'last_update\'', (id,)).fetchone()
+				if row is not None and not self.is_expired({"last_update": json.loads(row[0])}):
+					return False
+				connection.execute('DELETE FROM sessions WHERE id=?', (id,))
+		return True
+	
+	### remove every expired session, returns the number of removed sessions
+	def sweep(self,ttl=None):
+		if ttl is None:
+			ttl		= self.settings['ttl']
+		if not ttl:
+			raise ValueError('No ttl is given.')
+		cutoff	= time.time()-ttl
+		if self.is_platform('raw'):
+			# every write replaces the file, so its modification time is the time of the last update
+			removed		= 0
+			extension	= self.get_value('extension') or ''
+			if extension and extension[0]!='.':
+				extension	= '.'+extension
+			for entry in self._scan(self.get_value('path'),self.get_value('shards')):
+				# only session files and temporary files left behind by killed processes
+				temporary	= entry.name.startswith('.tmp-')
+				if not temporary and (entry.name.startswith('.') or not entry.name.endswith(extension)):
+					continue
+				if temporary:
+					try:
+						if entry.stat().st_mtime<cutoff:
+							os.remove(entry.path)
+					except FileNotFoundError:
+						pass
+					continue
+				id		= entry.name[:len(entry.name)-len(extension)] if extension else entry.name
+				if self.cache is not None and id in self._dirty:
+					continue
+				# checked again under the lock, another process may have just updated the session
+				with self.file_lock(id):
+					try:
+						if os.stat(entry.path).st_mtime>=cutoff:
+							continue
+						os.remove(entry.path)
+					except FileNotFoundError:
+						continue
+				removed		+= 1
+				if self.cache is not None:
+					self._forget(id)
+			return removed
+		elif self.is_platform('sqlite'):
+			with self._transaction() as connection:
+				expired	= 'SELECT id FROM sessions WHERE key=\'last_update\' AND CAST(value AS INTEGER)<?'
+				removed	= connection.execute('SELECT COUNT(*) FROM (' + expired + ')', (cutoff,)).fetchone()[0]
+				connection.execute('DELETE FROM sessions WHERE id IN (' + expired + ')', (cutoff,))
+			return removed
+		return 0
+	
+	### iterate over session files without listing whole directories in memory
+	def _scan(self,path,shards):
+		try:
+			entries	= os.scandir(path or '.')
+		except FileNotFoundError:
+			return
+		with entries:
+			for entry in entries:
+				if shards and entry.is_dir(follow_symlinks=False):
+					yield from self._scan(entry.path,shards-1)
+				elif entry.is_file(follow_symlinks=False):
+					yield entry
+	
+	### store a document (written on the next flush if cached)
+	def _save(self,id,data):
+		if self.cache is None:
+			return self.file_command('set',id,data)
+		with self._lock:
+			# marked first, the document may be pushed out (and written) by set() right away
+			self._dirty.add(id)
+			self.cache.set(id,data)
+		self._write_evicted()
+		return {}
+	
+	### write changed documents (of id, or every document)
+	def flush(self,id=None):
+		if self.cache is None:
+			return
+		with self._lock:
+			ids		= [id] if id is not None else list(self._dirty)
+		for id in ids:
+			with self.file_lock(id):
+				with self._lock:
+					if id not in self._dirty:
+						continue
+					data	= self.cache.get(id)
+					self._dirty.discard(id)
+				if data is not None:
+					self._write_document(id,data)
+		self._write_evicted()
+	
+	### called by the cache (with self._lock held) for documents it pushes out, changed ones are written by _write_evicted()
+	def _evicted(self,id,data):
+		with self._lock:
+			if id in self._dirty:
+				self._dirty.discard(id)
+				self._writing[id]	= data
+	
+	def _write_evicted(self):
+		if not self._writing:
+			return
+		for id in list(self._writing):
+			if self._holds_other_stripe(id):
+				# waiting for another lock could deadlock, a later call (or flush) writes it
+				continue
+			with self.file_lock(id):
+				with self._lock:
+					data	= self._writing.get(id)
+				if data is None:
+					continue
+				self.file_command('set',id,data)
+				with self._lock:
+					if self._writing.get(id) is data:
+						del self._writing[id]
+	
+	def _holds_other_stripe(self,id):
+		held	= getattr(self._local, 'stripes', None)
+		if not held:
+			return False
+		return bool(held - {zlib.crc32(id.encode('utf-8')) % len(self._stripes)})
+	
+	### write a changed document, it is marked as changed again if writing fails
+	def _write_document(self,id,data):
+		try:
+			self.file_command('set',id,data)
+		except:
+			with self._lock:
+				if self.cache.get(id) is data:
+					self._dirty.add(id)
+			raise
+	
+	def _flush_periodically(self):
+		while True:
+			time.sleep(self.settings['cache']['flush_interval'])
+			try:
+				self.flush()
+			except Exception:
+				pass
+	
 	def file_as_dict(self,id,key,value=None):
-		data	= self.file_command('get',id)
-		if value is not None:
-			data['last_update']= int(time.time())
-			data[key]	= value
-			new_data	= self.file_command('set',id,data)
+		if value is None:
+			data	= self._load(id)
+		else:
+			with self.file_lock(id):
+				data	= self._load(id)
+				data['last_update']= int(time.time())
+				data[key]	= value
+				new_data	= self._save(id,data)
 		if key in data:
 			return data[key]
 		return None
 	
+	### SQLite connection of the current thread
+	def _sqlite(self):
+		self._check_pid()
+		connection	= getattr(self._local, 'connection', None)
+		if connection is None:
+			connection	= sqlite3.connect(self.get_value('path'), timeout=self.get_value('timeout'), isolation_level=None)
+			# WAL lets readers work while another process writes
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			connection.execute('''CREATE TABLE IF NOT EXISTS sessions (
+				id			TEXT NOT NULL,
+				key			TEXT NOT NULL,
+				value		TEXT NOT NULL,
+				PRIMARY KEY (id, key)
+			) WITHOUT ROWID''')
+			connection.execute('CREATE INDEX IF NOT EXISTS sessions_key ON sessions (key)')
+			self._local.connection	= connection
+		return connection
+	
+	@contextlib.contextmanager
+	def _transaction(self):
+		connection	= self._sqlite()
+		connection.execute('BEGIN IMMEDIATE')
+		try:
+			yield connection
+		except:
+			connection.execute('ROLLBACK')
+			raise
+		connection.execute('COMMIT')
+	
+	def sqlite_get(self,id,key):
+		with _stage_timer(self.metrics,'session_read'):
+			return self._sqlite_get(id,key)
+	
+	def _sqlite_get(self,id,key):
+		if self.settings['ttl']:
+			rows	= dict(self._sqlite().execute('SELECT key, value FROM sessions WHERE id=? AND key IN (?, \'last_update\')', (id, key)).fetchall())
+			if 'last_update' in rows and self.is_expired({"last_update": json.loads(rows['last_update'])}):
+				if self._expire(id):
+					return None
+				return self._sqlite_get(id,key)
+			row		= (rows[key],) if key in rows else None
+		else:
+			row		= self._sqlite().execute('SELECT value FROM sessions WHERE id=? AND key=?', (id, key)).fetchone()
+		if row is not None:
+			return json.loads(row[0])
+		return None
+	
+	def sqlite_set(self,id,key,value=None):
+		if value is None:
+			return self.sqlite_get(id,key)
+		with _stage_timer(self.metrics,'session_write'), self._transaction() as connection:
+			connection.executemany('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, ?, ?)', ((id, key, json.dumps(value)), (id, 'last_update', json.dumps(int(time.time())))))
+		return value
+	
+	### append to a list and trim it to max_length in a single transaction
+	def sqlite_append(self,id,key,value,max_length):
+		with _stage_timer(self.metrics,'session_write'), self._transaction() as connection:
+			connection.execute('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, \'last_update\', ?)', (id, json.dumps(int(time.time()))))
+			if not connection.execute('UPDATE sessions SET value=json_insert(value, \'$[#]\', json(?)) WHERE id=? AND key=? AND json_type(value)=\'array\'', (json.dumps(value), id, key)).rowcount:
+				connection.execute('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, ?, json_array(json(?)))', (id, key, json.dumps(value)))
+			while connection.execute('UPDATE sessions SET value=json_remove(value, \'$[0]\') WHERE id=? AND key=? AND json_array_length(value)>?', (id, key, max_length)).rowcount:
+				pass
+			row		= connection.execute('SELECT value FROM sessions WHERE id=? AND key=?', (id, key)).fetchone()
+		return json.loads(row[0])
+	
+	def sqlite_remove(self,id):
+		self._sqlite().execute('DELETE FROM sessions WHERE id=?', (id,))
+		return {}
+	
 	def get(self,id,key):
 		if self.is_platform('raw'):
 			return self.file_as_dict(id,key)
+		elif self.is_platform('sqlite'):
+			return self.sqlite_get(id,key)
 	
 	def set(self,id,key,value):
 		if self.is_platform('raw'):
 			return self.file_as_dict(id,key,value)
+		elif self.is_platform('sqlite'):
+			return self.sqlite_set(id,key,value)
 	
 	def clear(self,id):
 		if self.is_platform('raw'):
+			self._forget(id)
 			return self.file_command('clear',id)
+		elif self.is_platform('sqlite'):
+			return self.sqlite_remove(id)
 		
 	def remove(self,id):
 		if self.is_platform('raw'):
-			return self.file_command('remove',id)
+			unsaved	= self._forget(id)
+			try:
+				return self.file_command('remove',id)
+			except FileNotFoundError:
+				if not unsaved:		# documents that were never flushed have no file yet
+					raise
+				return {}
+		elif self.is_platform('sqlite'):
+			return self.sqlite_remove(id)
+	
+	### drop cached document
+	def _forget(self,id):
+		if self.cache is not None:
+			with self._lock:
+				self.cache.pop(id)
+				pending	= self._writing.pop(id, None) is not None
+				if id in self._dirty or pending:
+					self._dirty.discard(id)
+					return True
+		return False
 	
 	def append(self,id,key,value=None,max_length=7):
 		if self.is_platform('raw'):
-			data	= self.file_command('get',id)
 			if max_length>0:
 				if value is not None:
-					data['last_update']= int(time.time())
-					if key in data and isinstance(data[key], list):
-						start		= len(data[key])-max_length+1
-						if start<0:
-								start	= 0
-						data[key]	= data[key][start:]
-					else:
-						data[key]	= []
-					data[key].append(value)
-					new_data	= self.file_command('set',id,data)
+					with self.file_lock(id):
+						data	= self._load(id)
+						data['last_update']= int(time.time())
+						if key in data and isinstance(data[key], list):
+							start		= len(data[key])-max_length+1
+							if start<0:
+									start	= 0
+							data[key]	= data[key][start:]
+						else:
+							data[key]	= []
+						data[key].append(value)
+						new_data	= self._save(id,data)
+				else:
+					data	= self._load(id)
 			else:
 				raise ValueError('Array length must be more than 0')
 			return data[key]
+		elif self.is_platform('sqlite'):
+			if max_length<=0:
+				raise ValueError('Array length must be more than 0')
+			if value is None:
+				return self.sqlite_get(id,key)
+			return self.sqlite_append(id,key,value,max_length)
+	
+	### read several keys of a session at once
+	def get_many(self,id,keys=[]):
+		if self.is_platform('raw'):
+			data	= self._load(id)
+		elif self.is_platform('sqlite'):
+			data	= self.sqlite_document(id,keys)
+		else:
+			return {}
+		return {key: data[key] if key in data else None for key in keys}
+	
+	### set several keys of a session at once
+	def set_many(self,id,values={}):
+		if self.is_platform('raw'):
+			with self.file_lock(id):
+				data	= self._load(id)
+				data.update(values)
+				data['last_update']= int(time.time())
+				self._save(id,data)
+		elif self.is_platform('sqlite'):
+			rows	= [(id, key, json.dumps(value)) for key, value in values.items()]
+			rows.append((id, 'last_update', json.dumps(int(time.time()))))
+			with self._transaction() as connection:
+				connection.executemany('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, ?, ?)', rows)
+		return values
+	
+	### read-modify-write a whole session: changes to the yielded dict are saved at the end of the with block (and dropped on errors)
+	@contextlib.contextmanager
+	def update(self,id):
+		if self.is_platform('raw'):
+			with self.file_lock(id):
+				data	= self._load(id)
+				if self.cache is not None:
+					data	= copy.deepcopy(data)	# the cached document only changes if the block succeeds
+				yield data
+				data['last_update']= int(time.time())
+				self._save(id,data)
+		elif self.is_platform('sqlite'):
+			with self._transaction() as connection:
+				original	= {key: value for key, value in connection.execute('SELECT key, value FROM sessions WHERE id=?', (id,))}
+				data		= {key: json.loads(value) for key, value in original.items()}
+				if self.is_expired(data):
+					connection.execute('DELETE FROM sessions WHERE id=?', (id,))
+					original	= {}
+					data		= {}
+				yield data
+				data['last_update']= int(time.time())
+				changed		= []
+				for key, value in data.items():
+					value	= json.dumps(value)
+					if key not in original or original[key]!=value:
+						changed.append((id, key, value))
+				connection.executemany('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, ?, ?)', changed)
+				connection.executemany('DELETE FROM sessions WHERE id=? AND key=?', [(id, key) for key in original if key not in data])
+		else:
+			yield {}
+	
+	### iterate over (id, document) pairs of several sessions, one read per session (per batch of sessions for SQLite)
+	def load_many(self,ids,batch_size=500):
+		if self.is_platform('raw'):
+			for id in ids:
+				yield id, self._load(id)
+		elif self.is_platform('sqlite'):
+			batch	= []
+			for id in ids:
+				batch.append(id)
+				if len(batch)>=batch_size:
+					yield from self._sqlite_load_batch(batch)
+					batch	= []
+			if batch:
+				yield from self._sqlite_load_batch(batch)
+	
+	def _sqlite_load_batch(self,ids):
+		documents	= {}
+		for id, key, value in self._sqlite().execute('SELECT id, key, value FROM sessions WHERE id IN (' + ','.join('?'*len(ids)) + ')', ids):
+			documents.setdefault(id,{})[key]	= json.loads(value)
+		for id in ids:
+			data	= documents.get(id,{})
+			if self.is_expired(data):
+				data	= {} if self._expire(id) else self.sqlite_document(id)
+			yield id, data
+	
+	### read a whole session (or only the given keys) from SQLite
+	def sqlite_document(self,id,keys=None):
+		if keys is None:
+			rows	= self._sqlite().execute('SELECT key, value FROM sessions WHERE id=?', (id,))
+		else:
+			names	= list(keys)+['last_update']
+			rows	= self._sqlite().execute('SELECT key, value FROM sessions WHERE id=? AND key IN (' + ','.join('?'*len(names)) + ')', [id]+names)
+		data	= {key: json.loads(value) for key, value in rows}
+		if self.is_expired(data):
+			if self._expire(id):
+				return {}
+			return self.sqlite_document(id,keys)
+		return data
 	
 	def dict_path(self,data={},path=[]):
-		if data and path:
-			if path[0] in data:
-				if isinstance(data[path[0]], dict):
-					return self.dict_path(data[path[0]],path[1:])
-				elif len(path)==1:
-					return data[path[0]]
+		if not data or not path:
+			return None
+		for key in path:
+			if isinstance(data, dict) and key in data:
+				data	= data[key]
+			elif isinstance(data, list) and isinstance(key, int) and -len(data)<=key<len(data):
+				data	= data[key]
+			else:
+				return None
+		return data
+	
+	### walk to the parent of the last key of path, missing or non dict levels are replaced with dicts
+	def _dict_parent(self,data,path):
+		for key in path[:-1]:
+			if isinstance(data, list) and isinstance(key, int) and -len(data)<=key<len(data) and isinstance(data[key], (dict, list)):
+				data		= data[key]
+			elif isinstance(data, dict):
+				if key not in data or not isinstance(data[key], (dict, list)):
+					data[key]	= {}
+				data		= data[key]
+			else:
+				raise ValueError('Path "%s" can not be set.' % (path))
+		return data
+	
+	### SQLite JSON path of the keys after the first one (None if it can not be expressed)
+	def _json_path(self,path):
+		json_path	= '$'
+		for key in path[1:]:
+			if isinstance(key, int):
+				if key<0:
+					return None
+				json_path	+= '[%d]' % (key)
+			elif '"' in key or '\\' in key:
+				return None
+			else:
+				json_path	+= '."%s"' % (key)
+		return json_path
+	
+	### read a nested value of a session, path is a list of keys (and list indexes)
+	def get_path(self,id,path=[]):
+		if not path:
+			return None
+		if self.is_platform('raw'):
+			return self.dict_path(self._load(id),path)
+		elif self.is_platform('sqlite'):
+			json_path	= self._json_path(path)
+			if json_path is None or self.settings['ttl']:
+				return self.dict_path({path[0]: self.sqlite_get(id,path[0])},path)
+			# only the requested subtree leaves the database
+			row		= self._sqlite().execute('SELECT json_quote(json_extract(value, ?)) FROM sessions WHERE id=? AND key=?', (json_path, id, path[0])).fetchone()
+			if row is not None and row[0] is not None:
+				return json.loads(row[0])
 		return None
 	
+	### set a nested value of a session in place, missing levels are created
+	def set_path(self,id,path=[],value=None):
+		if not path:
+			raise ValueError('No path is given.')
+		if self.is_platform('raw'):
+			with self.file_lock(id):
+				data	= self._load(id)
+				self._dict_parent(data,path)[path[-1]]	= value
+				data['last_update']= int(time.time())
+				self._save(id,data)
+		elif self.is_platform('sqlite'):
+			json_path	= self._json_path(path)
+			written		= False
+			if len(path)>1 and json_path is not None:
+				with self._transaction() as connection:
+					if any(isinstance(key, int) for key in path[1:]):
+						# json_set appends at index == length where lists raise IndexError, so list items are only replaced
+						row		= connection.execute('SELECT json_type(value, ?) FROM sessions WHERE id=? AND key=?', (json_path, id, path[0])).fetchone()
+						if row is not None and row[0] is not None:
+							connection.execute('UPDATE sessions SET value=json_set(value, ?, json(?)) WHERE id=? AND key=?', (json_path, json.dumps(value), id, path[0]))
+							written	= True
+					else:
+						if not connection.execute('UPDATE sessions SET value=json_set(value, ?, json(?)) WHERE id=? AND key=? AND json_type(value) IN (\'object\', \'array\')', (json_path, json.dumps(value), id, path[0])).rowcount:
+							connection.execute('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, ?, json_set(\'{}\', ?, json(?)))', (id, path[0], json_path, json.dumps(value)))
+						# json_set leaves the document unchanged if a level of the path is not an object
+						row		= connection.execute('SELECT json_type(value, ?) FROM sessions WHERE id=? AND key=?', (json_path, id, path[0])).fetchone()
+						written	= row is not None and row[0] is not None
+					if written:
+						connection.execute('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, \'last_update\', ?)', (id, json.dumps(int(time.time()))))
+			if not written:
+				# same rules as the raw platform (scalar levels are replaced, list indexes must exist)
+				with self.update(id) as data:
+					self._dict_parent(data,path)[path[-1]]	= value
+		return value
+	
+	### append to a nested list of a session, keeping at most max_length items
+	def append_path(self,id,path=[],value=None,max_length=7):
+		if not path:
+			raise ValueError('No path is given.')
+		if max_length<=0:
+			raise ValueError('Array length must be more than 0')
+		if len(path)==1:
+			return self.append(id,path[0],value,max_length)
+		if value is None:
+			return self.get_path(id,path)
+		if self.is_platform('raw'):
+			with self.file_lock(id):
+				data	= self._load(id)
+				parent	= self._dict_parent(data,path)
+				items	= parent[path[-1]] if isinstance(parent, dict) and path[-1] in parent else None
+				if not isinstance(items, list):
+					items	= []
+				items.append(value)
+				del items[:max(len(items)-max_length,0)]
+				parent[path[-1]]	= items
+				data['last_update']= int(time.time())
+				self._save(id,data)
+			return items
+		elif self.is_platform('sqlite'):
+			json_path	= self._json_path(path)
+			# json_set appends at index == length where lists raise IndexError, paths through lists take the raw rules
+			if json_path is None or any(isinstance(key, int) for key in path[1:]):
+				return self._append_path_document(id,path,value,max_length)
+			with self._transaction() as connection:
+				connection.execute('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, \'last_update\', ?)', (id, json.dumps(int(time.time()))))
+				if not connection.execute('UPDATE sessions SET value=json_insert(value, ?, json(?)) WHERE id=? AND key=? AND json_type(value, ?)=\'array\'', (json_path+'[#]', json.dumps(value), id, path[0], json_path)).rowcount:
+					if not connection.execute('UPDATE sessions SET value=json_set(value, ?, json_array(json(?))) WHERE id=? AND key=? AND json_type(value) IN (\'object\', \'array\')', (json_path, json.dumps(value), id, path[0])).rowcount:
+						connection.execute('INSERT OR REPLACE INTO sessions (id, key, value) VALUES (?, ?, json_set(\'{}\', ?, json_array(json(?))))', (id, path[0], json_path, json.dumps(value)))
+				while connection.execute('UPDATE sessions SET value=json_remove(value, ?) WHERE id=? AND key=? AND json_array_length(value, ?)>?', (json_path+'[0]', id, path[0], json_path, max_length)).rowcount:
+					pass
+				row		= connection.execute('SELECT json_extract(value, ?) FROM sessions WHERE id=? AND key=?', (json_path, id, path[0])).fetchone()
+			if row is None or row[0] is None:
+				# json_set leaves the document unchanged if a level of the path is not an object
+				return self._append_path_document(id,path,value,max_length)
+			return json.loads(row[0])
+	
+	def _append_path_document(self,id,path,value,max_length):
+		with self.update(id) as data:
+			parent	= self._dict_parent(data,path)
+			items	= parent[path[-1]] if isinstance(parent, dict) and path[-1] in parent else None
+			if not isinstance(items, list):
+				items	= []
+			items.append(value)
+			del items[:max(len(items)-max_length,0)]
+			parent[path[-1]]	= items
+		return items
+	
+class Metrics:
+	''' Timings of the stages messages go through and counters of results, exported as a dict (stats) or in the Prometheus text format
+		hooks are called with (name, value, labels) for every observation, e.g. to forward them to statsd '''
+	
+	STAGES				= ('parse','translate','compile','http','response','session_read','session_write')
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,prefix='phemia',hooks=[]):
+		self.prefix		= prefix
+		self.hooks		= list(hooks)
+		self._timings	= {}			# stage => [count, sum, max]
+		self._counters	= {}			# (name, labels) => value
+		self._lock		= threading.Lock()
+	
+	def add_hook(self,hook):
+		self.hooks.append(hook)
+		return hook
+	
+	def observe(self,stage,seconds):
+		with self._lock:
+			timing	= self._timings.get(stage)
+			if timing is None:
+				timing	= self._timings[stage]	= [0, 0.0, 0.0]
+			timing[0]	+= 1
+			timing[1]	+= seconds
+			if seconds>timing[2]:
+				timing[2]	= seconds
+		for hook in self.hooks:
+			hook('stage_seconds', seconds, {"stage": stage})
+	
+	@contextlib.contextmanager
+	def timer(self,stage):
+		start	= time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(stage, time.perf_counter()-start)
+	
+	### time every step of an iterator (e.g. parsing the next event of a stream)
+	def iterate(self,stage,iterable):
+		iterator	= iter(iterable)
+		while True:
+			start	= time.perf_counter()
+			try:
+				item	= next(iterator)
+			except StopIteration:
+				return
+			self.observe(stage, time.perf_counter()-start)
+			yield item
+	
+	def count(self,name,value=1,**labels):
+		key		= (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._counters[key]	= self._counters.get(key, 0) + value
+		for hook in self.hooks:
+			hook(name, value, labels)
+	
+	### count the status code and error of a send() result
+	def count_result(self,platform,result):
+		request	= result.get('request') or {}
+		if request.get('status_code') is not None:
+			self.count('responses', platform=platform, status=str(request['status_code']))
+		error	= result.get('error')
+		if error:
+			self.count('errors', platform=str(error.get('platform')), type=str(error.get('type', error.get('code'))))
+	
+	def reset(self):
+		with self._lock:
+			self._timings.clear()
+			self._counters.clear()
+	
+	def stats(self):
+		stats	= {"stages": {}, "counters": {}}
+		with self._lock:
+			for stage, (count, total, maximum) in self._timings.items():
+				stats['stages'][stage]	= {
+					"count"		: count,
+					"sum"		: total,
+					"max"		: maximum,
+					"avg"		: total/count if count else 0.0
+				}
+			for (name, labels), value in self._counters.items():
+				stats['counters'].setdefault(name, []).append(dict(labels, value=value))
+		return stats
+	
+	def prometheus(self):
+		with self._lock:
+			timings		= sorted((stage, list(timing)) for stage, timing in self._timings.items())
+			counters	= sorted(self._counters.items())
+		lines	= []
+		if timings:
+			name	= self.prefix + '_stage_seconds'
+			lines.append('# HELP %s Time spent per stage.' % (name))
+			lines.append('# TYPE %s summary' % (name))
+			for stage, (count, total, maximum) in timings:
+				lines.append('%s_count{stage="%s"} %d' % (name, _prometheus_escape(stage), count))
+				lines.append('%s_sum{stage="%s"} %r' % (name, _prometheus_escape(stage), total))
+			lines.append('# HELP %s_max Longest time spent per stage.' % (name))
+			lines.append('# TYPE %s_max gauge' % (name))
+			for stage, (count, total, maximum) in timings:
+				lines.append('%s_max{stage="%s"} %r' % (name, _prometheus_escape(stage), maximum))
+		last	= None
+		for (counter, labels), value in counters:
+			name	= self.prefix + '_' + counter + '_total'
+			if counter!=last:
+				lines.append('# TYPE %s counter' % (name))
+				last	= counter
+			labels	= ','.join('%s="%s"' % (key, _prometheus_escape(label)) for key, label in labels)
+			lines.append('%s{%s} %r' % (name, labels, value) if labels else '%s %r' % (name, value))
+		return '\n'.join(lines) + '\n'
+
+def _prometheus_escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class JSONStream:
+	''' Incremental reader of a JSON document from a binary stream, values are decoded as soon as they are complete
+		object_keys() and array_items() walk containers, the value of every key / item has to be read (value()) or walked before the next one '''
+	
+	WHITESPACE			= ' \t\n\r'
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,stream,chunk_size=65536):
+		self.stream		= stream
+		self.chunk_size	= chunk_size
+		self._decoder	= codecs.getincrementaldecoder('utf-8')()
+		self._json		= json.JSONDecoder()
+		self._buffer	= ''
+		self._pos		= 0
+		self._eof		= False
+	
+	### read the next chunk (the part of the buffer that was already parsed is dropped)
+	def _fill(self):
+		if self._eof:
+			return False
+		chunk			= self.stream.read(self.chunk_size)
+		if not chunk:
+			self._eof	= True
+		self._buffer	= self._buffer[self._pos:] + self._decoder.decode(chunk or b'', final=not chunk)
+		self._pos		= 0
+		return True
+	
+	### next non-whitespace character ('' at the end of the stream)
+	def peek(self):
+		while True:
+			buffer	= self._buffer
+			while self._pos<len(buffer) and buffer[self._pos] in self.WHITESPACE:
+				self._pos	+= 1
+			if self._pos<len(buffer):
+				return buffer[self._pos]
+			if not self._fill():
+				return ''
+	
+	def _expect(self,char):
+		if self.peek()!=char:
+			raise ValueError('Expected "%s" at character %d of the current chunk.' % (char, self._pos))
+		self._pos	+= 1
+	
+	### decode the next complete value
+	def value(self):
+		self.peek()
+		while True:
+			try:
+				value, end	= self._json.raw_decode(self._buffer, self._pos)
+				# numbers and literals at the end of the buffer may continue in the next chunk
+				if end<len(self._buffer) or self._eof:
+					self._pos	= end
+					return value
+			except json.JSONDecodeError:
+				if self._eof:
+					raise
+			self._fill()
+	
+	def object_keys(self):
+		self._expect('{')
+		if self.peek()=='}':
+			self._pos	+= 1
+			return
+		while True:
+			key		= self.value()
+			self._expect(':')
+			yield key
+			char	= self.peek()
+			self._pos	+= 1
+			if char=='}':
+				return
+			if char!=',':
+				raise ValueError('Expected "," or "}" at character %d of the current chunk.' % (self._pos-1))
+	
+	def array_items(self):
+		self._expect('[')
+		if self.peek()==']':
+			self._pos	+= 1
+			return
+		while True:
+			yield
+			char	= self.peek()
+			self._pos	+= 1
+			if char==']':
+				return
+			if char!=',':
+				raise ValueError('Expected "," or "]" at character %d of the current chunk.' % (self._pos-1))
+
+### messaging events of a facebook webhook call read from a JSONStream, one at a time
+def iter_facebook_events(stream):
+	for key in stream.object_keys():
+		if key=='entry' and stream.peek()=='[':
+			for _ in stream.array_items():
+				if stream.peek()!='{':
+					stream.value()
+					continue
+				for entry_key in stream.object_keys():
+					if entry_key=='messaging' and stream.peek()=='[':
+						for _ in stream.array_items():
+							yield stream.value()
+					else:
+						stream.value()
+		else:
+			stream.value()
+
+class Model(collections.abc.MutableMapping):
+	''' Base of compact message objects: fields are stored in __slots__ and can be used as dict keys as well, unset fields are missing keys '''
+	
+	__slots__	= ()
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,data=None,**fields):
+		if data:
+			for key, value in data.items():
+				self[key]	= value
+		for key, value in fields.items():
+			self[key]	= value
+	
+	def __getitem__(self,key):
+		try:
+			return getattr(self, key) if key in self._fields else self._missing(key)
+		except AttributeError:
+			raise KeyError(key)
+	
+	def __setitem__(self,key,value):
+		if key not in self._fields:
+			raise KeyError('"%s" is not a field of %s.' % (key, type(self).__name__))
+		setattr(self, key, value)
+	
+	def __delitem__(self,key):
+		try:
+			delattr(self, key) if key in self._fields else self._missing(key)
+		except AttributeError:
+			raise KeyError(key)
+	
+	def __contains__(self,key):
+		return key in self._fields and hasattr(self, key)
+	
+	def __iter__(self):
+		for key in self.__slots__:
+			if hasattr(self, key):
+				yield key
+	
+	def __len__(self):
+		return sum(1 for key in self)
+	
+	def __repr__(self):
+		return '%s(%r)' % (type(self).__name__, self.to_dict())
+	
+	def _missing(self,key):
+		raise KeyError(key)
+	
+	### plain dict (nested objects are converted too)
+	def to_dict(self):
+		return {key: _to_plain(self[key]) for key in self}
+	
+	### default= of json.dumps
+	@staticmethod
+	def to_json(obj):
+		if isinstance(obj, Model):
+			return obj.to_dict()
+		raise TypeError('Object of type %s is not JSON serializable' % (type(obj).__name__))
+
+class Button(Model):
+	__slots__	= ('text','type','value','image')
+	_fields		= frozenset(__slots__)
+
+class Attachment(Model):
+	__slots__	= ('url','type','reusable','title','description','sticker','latitude','longitude','buttons','cache')
+	_fields		= frozenset(__slots__)
+	
+	def __setitem__(self,key,value):
+		if key=='buttons' and value:
+			value	= [button if isinstance(button, Button) else Button(button) for button in value]
+		Model.__setitem__(self,key,value)
+
+class Message(Model):
+	__slots__	= ('sender','recipient','text','attachment','other','raw')
+	_fields		= frozenset(__slots__)
+	
+	def __setitem__(self,key,value):
+		if key=='attachment' and value:
+			value	= [item if isinstance(item, Attachment) else Attachment(item) for item in value]
+		Model.__setitem__(self,key,value)
+
+def _to_plain(value):
+	if isinstance(value, Model):
+		return value.to_dict()
+	if isinstance(value, list):
+		return [_to_plain(item) for item in value]
+	return value
+
+class TokenBucket:
+	''' Thread safe token bucket rate limiter '''
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,rate=0,burst=1):
+		self.rate		= rate			# tokens added per second (0 for unlimited)
+		self.burst		= max(burst,1)	# max. number of tokens stored
+		self._tokens	= float(self.burst)
+		self._last		= time.monotonic()
+		self._lock		= threading.Lock()
+	
+	### block until a token is available
+	def take(self):
+		if not self.rate:
+			return
+		while True:
+			with self._lock:
+				now				= time.monotonic()
+				self._tokens	= min(self.burst, self._tokens+(now-self._last)*self.rate)
+				self._last		= now
+				if self._tokens>=1:
+					self._tokens	-= 1
+					return
+				wait			= (1-self._tokens)/self.rate
+			time.sleep(wait)
+
+class SendQueue:
+	''' Background delivery of compiled messages with rate limiting, retries and per recipient ordering '''
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,messaging,settings):
+		self.messaging	= messaging
+		self.settings	= settings
+		self.bucket		= TokenBucket(settings['rate'],settings['burst'])
+		self.sent		= 0
+		self.failed		= 0
+		self.retried	= 0
+		self._lock		= threading.Lock()	# counters are updated by every worker
+		self._queues	= []
+		self._threads	= []
+		for i in range(max(settings['workers'],1)):
+			worker_queue	= queue.Queue()
+			thread			= threading.Thread(target=self._work, args=(worker_queue,), name='phemia-send-%d' % (i), daemon=True)
+			self._queues.append(worker_queue)
+			self._threads.append(thread)
+			thread.start()
+		# workers are daemon threads, queued messages are sent before the interpreter exits (CGI)
+		atexit.register(self.close)
+	
+	### messages of a recipient are always handled by the same worker, so they arrive in order
+	def put(self,compiled):
+		if not self._threads:
+			raise ValueError('Queue is already closed.')
+		recipient	= compiled['recipient']['id'] if compiled['recipient'] and 'id' in compiled['recipient'] else None
+		self._queues[hash(str(recipient)) % len(self._queues)].put(compiled)
+	
+	def qsize(self):
+		return sum(worker_queue.qsize() for worker_queue in self._queues)
+	
+	### wait until every queued message is handled
+	def join(self,timeout=None):
+		deadline	= time.monotonic()+timeout if timeout is not None else None
+		for worker_queue in self._queues:
+			with worker_queue.all_tasks_done:
+				while worker_queue.unfinished_tasks:
+					if deadline is None:
+						worker_queue.all_tasks_done.wait()
+					else:
+						remaining	= deadline-time.monotonic()
+						if remaining<=0:
+							return False
+						worker_queue.all_tasks_done.wait(remaining)
+		return True
+	
+	### send remaining messages and stop workers
+	def close(self):
+		if not self._threads:
+			return
+		for worker_queue in self._queues:
+			worker_queue.put(None)
+		for thread in self._threads:
+			thread.join()
+		self._threads	= []
+	
+	def _work(self,worker_queue):
+		while True:
+			compiled	= worker_queue.get()
+			try:
+				if compiled is None:
+					return
+				result	= self._deliver(compiled)
+				if self.settings['callback']:
+					self.settings['callback'](compiled,result)
+			except Exception as e:
+				self.messaging.log("Queued message could not be sent", error=repr(e))
+			finally:
+				worker_queue.task_done()
+	
+	def _deliver(self,compiled):
+		attempt	= 0
+		while True:
+			self.bucket.take()
+			result	= self.messaging.send_compiled(compiled)
+			if not self.messaging.should_retry(result):
+				with self._lock:
+					self.sent	+= 1
+				return result
+			if attempt>=self.settings['retries']:
+				with self._lock:
+					self.failed	+= 1
+				return result
+			# exponential backoff with jitter, facebook's Retry-After is respected when given
+			wait	= min(self.settings['backoff']*(2**attempt), self.settings['max_backoff'])
+			wait	= wait/2+random.uniform(0,wait/2)
+			try:
+				wait	= max(wait, float(result['request']['headers']['Retry-After']))
+			except (KeyError, TypeError, ValueError):
+				pass
+			attempt			+= 1
+			with self._lock:
+				self.retried	+= 1
+			time.sleep(wait)
+	
+	def stats(self):
+		return {
+			"queued"	: self.qsize(),
+			"sent"		: self.sent,
+			"failed"	: self.failed,
+			"retried"	: self.retried
+		}
+
+class Outbox:
+	''' Durable outbox of compiled messages stored in a local SQLite file '''
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,path,timeout=30):
+		if not path:
+			raise ValueError('No outbox file is given.')
+		self.path		= path
+		self.timeout	= timeout
+		self._local		= threading.local()
+	
+	### one connection per thread
+	def _connection(self):
+		connection	= getattr(self._local, 'connection', None)
+		if connection is None:
+			connection	= sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+			# WAL with synchronous=NORMAL only syncs on checkpoints, so appends stay fast but survive process exit
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			connection.execute('''CREATE TABLE IF NOT EXISTS outbox (
+				id			INTEGER PRIMARY KEY AUTOINCREMENT,
+				platform	TEXT NOT NULL,
+				recipient	TEXT NOT NULL,
+				sender		TEXT NOT NULL,
+				body		BLOB NOT NULL,
+				status		TEXT NOT NULL DEFAULT 'pending',
+				attempts	INTEGER NOT NULL DEFAULT 0,
+				next_try	REAL NOT NULL DEFAULT 0,
+				created		REAL NOT NULL,
+				error		TEXT
+			)''')
+			connection.execute('CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id)')
+			self._local.connection	= connection
+		return connection
+	
+	### store a message created by Messaging.compile(), returns its id
+	def put(self,compiled):
+		cursor	= self._connection().execute('INSERT INTO outbox (platform, recipient, sender, body, created) VALUES (?, ?, ?, ?, ?)', (compiled['platform'], json.dumps(compiled['recipient']), json.dumps(compiled['sender']), compiled['body'], time.time()))
+		return cursor.lastrowid
+	
+	def count(self,status='pending'):
+		return self._connection().execute('SELECT COUNT(*) FROM outbox WHERE status=?', (status,)).fetchone()[0]
+	
+	### delete delivered messages
+	def purge(self,status='done'):
+		return self._connection().execute('DELETE FROM outbox WHERE status=?', (status,)).rowcount
+	
+	### deliver pending messages in order, messages of a recipient wait for earlier ones that are retried
+	def drain(self,messaging,limit=None,batch_size=100):
+		settings	= messaging.settings['outbox']
+		connection	= self._connection()
+		stats		= {"sent": 0, "retried": 0, "failed": 0}
+		blocked		= set()
+		last_id		= 0
+		handled		= 0
+		while limit is None or handled<limit:
+			rows	= connection.execute('SELECT id, platform, recipient, sender, body, attempts, next_try FROM outbox WHERE status IN (\'pending\', \'sending\') AND id>? ORDER BY id LIMIT ?', (last_id, batch_size)).fetchall()
+			if not rows:
+				break
+			for id, platform, recipient, sender, body, attempts, next_try in rows:
+				last_id		= id
+				recipient	= json.loads(recipient)
+				key			= str(recipient['id']) if 'id' in recipient else None
+				if key in blocked:
+					continue
+				# waiting for a retry or being sent by another drainer
+				if next_try>time.time():
+					blocked.add(key)
+					continue
+				if limit is not None and handled>=limit:
+					break
+				# claim the message, drainers running at the same time never send it twice
+				if not connection.execute('UPDATE outbox SET status=\'sending\', next_try=? WHERE id=? AND status IN (\'pending\', \'sending\') AND next_try=?', (time.time()+settings['lease'], id, next_try)).rowcount:
+					blocked.add(key)
+					continue
+				handled		+= 1
+				result		= messaging.send_compiled({
+					"platform"	: platform,
+					"recipient"	: recipient,
+					"sender"	: json.loads(sender),
+					"payload"	: json.loads(body),
+					"body"		: body
+				})
+				attempts	+= 1
+				if not messaging.should_retry(result):
+					if result['error']:
+						stats['failed']	+= 1
+						connection.execute('UPDATE outbox SET status=\'failed\', attempts=?, error=? WHERE id=?', (attempts, json.dumps(result['error']), id))
+					else:
+						stats['sent']	+= 1
+						connection.execute('UPDATE outbox SET status=\'done\', attempts=?, error=NULL WHERE id=?', (attempts, id))
+				elif attempts>=settings['retries']:
+					stats['failed']	+= 1
+					connection.execute('UPDATE outbox SET status=\'failed\', attempts=?, error=? WHERE id=?', (attempts, json.dumps(result['error']), id))
+				else:
+					stats['retried']+= 1
+					wait			= min(settings['backoff']*(2**(attempts-1)), settings['max_backoff'])
+					connection.execute('UPDATE outbox SET status=\'pending\', attempts=?, next_try=?, error=? WHERE id=?', (attempts, time.time()+wait, json.dumps(result['error']), id))
+					blocked.add(key)
+		return stats
+	
+	def close(self):
+		connection	= getattr(self._local, 'connection', None)
+		if connection is not None:
+			connection.close()
+			self._local.connection	= None
+
+class MessageIndex:
+	''' Bounded index of received message ids (mids): the latest ids are kept in memory and optionally in a SQLite file shared by processes '''
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,size=4096,path=None,timeout=30):
+		self.size		= size			# max. number of ids kept (in memory and in the file)
+		self.path		= path
+		self.timeout	= timeout
+		self.duplicates	= 0
+		self._ring		= collections.deque()
+		self._ids		= set()
+		self._lock		= threading.Lock()
+		self._local		= threading.local()
+	
+	def __len__(self):
+		return len(self._ids)
+	
+	def __contains__(self,mid):
+		if mid in self._ids:
+			return True
+		if self.path:
+			return self._connection().execute('SELECT 1 FROM mids WHERE mid=?', (mid,)).fetchone() is not None
+		return False
+	
+	### one connection per thread
+	def _connection(self):
+		connection	= getattr(self._local, 'connection', None)
+		if connection is None:
+			connection	= sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			connection.execute('CREATE TABLE IF NOT EXISTS mids (mid TEXT PRIMARY KEY)')
+			self._local.connection	= connection
+		return connection
+	
+	### remember a message id, returns True if it was seen before
+	def add(self,mid):
+		with self._lock:
+			if mid in self._ids:
+				self.duplicates	+= 1
+				return True
+			self._ids.add(mid)
+			self._ring.append(mid)
+			if len(self._ring)>self.size:
+				self._ids.discard(self._ring.popleft())
+		if self.path:
+			# INSERT OR IGNORE decides atomically between processes
+			connection	= self._connection()
+			cursor		= connection.execute('INSERT OR IGNORE INTO mids (mid) VALUES (?)', (mid,))
+			if not cursor.rowcount:
+				with self._lock:
+					self.duplicates	+= 1
+				return True
+			# trim old ids from time to time
+			if cursor.lastrowid%256==0:
+				connection.execute('DELETE FROM mids WHERE rowid<=?', (cursor.lastrowid-self.size,))
+		return False
+	
+	def clear(self):
+		with self._lock:
+			self._ring.clear()
+			self._ids.clear()
+		if self.path:
+			self._connection().execute('DELETE FROM mids')
+	
+	def stats(self):
+		return {
+			"size"			: len(self._ids),
+			"max_size"		: self.size,
+			"duplicates"	: self.duplicates
+		}
+
+class Logger:
+	''' Structured log (one JSON object per line) written by a background thread: records wait in a bounded buffer (records that don't fit
+		are dropped and counted), the file is rotated by size and payloads are truncated / sampled '''
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,path,buffer_size=10000,max_bytes=10485760,backups=3,payload_length=1000,payload_sample=1.0):
+		if not path:
+			raise ValueError('No log file is given.')
+		self.path			= path
+		self.max_bytes		= max_bytes
+		self.backups		= backups
+		self.payload_length	= payload_length
+		self.payload_sample	= payload_sample
+		self.written		= 0
+		self.dropped		= 0
+		self.sampled		= 0				# payloads left out by sampling
+		self.errors			= 0				# failed writes
+		self._queue			= queue.Queue(buffer_size)
+		self._encoder		= json.JSONEncoder(default=str)
+		self._file			= None
+		self._size			= 0
+		self._thread		= None
+		self._lock			= threading.Lock()
+	
+	def log(self,message,payload=None,level='error',**fields):
+		record	= {"time": time.time(), "level": level, "message": message}
+		if fields:
+			record.update(fields)
+		if payload is not None:
+			if self.payload_sample>=1 or random.random()<self.payload_sample:
+				record['payload']	= self._dump(payload)
+			else:
+				self.sampled	+= 1
+		if self._thread is None:
+			self._start()
+		try:
+			self._queue.put_nowait(record)
+		except queue.Full:
+			with self._lock:
+				self.dropped	+= 1
+			return False
+		return True
+	
+	### JSON of a payload, encoding stops once payload_length characters are reached
+	def _dump(self,payload):
+		parts	= []
+		length	= 0
+		try:
+			for part in self._encoder.iterencode(payload):
+				parts.append(part)
+				length	+= len(part)
+				if length>self.payload_length:
+					return ''.join(parts)[:self.payload_length] + '... (truncated)'
+		except (TypeError, ValueError) as e:
+			return repr(e)
+		return ''.join(parts)
+	
+	def _start(self):
+		with self._lock:
+			if self._thread is None:
+				self._thread	= threading.Thread(target=self._run, daemon=True)
+				self._thread.start()
+				atexit.register(self.close)
+	
+	### write every waiting record at once, the file is kept open between writes
+	def _run(self):
+		while True:
+			records	= [self._queue.get()]
+			try:
+				while len(records)<1000:
+					records.append(self._queue.get_nowait())
+			except queue.Empty:
+				pass
+			lines	= ''.join(json.dumps(record, default=str) + '\n' for record in records if record is not None)
+			try:
+				if lines:
+					self._write(lines)
+					self.written	+= len(records) - records.count(None)
+			except OSError:
+				self.errors	+= 1
+				self._close_file()
+			for record in records:
+				self._queue.task_done()
+			if None in records:
+				self._close_file()
+				return
+	
+	def _write(self,lines):
+		if self._file is None:
+			self._file	= open(self.path, 'a', encoding='utf-8')
+			self._size	= self._file.tell()
+		self._file.write(lines)
+		self._file.flush()
+		self._size	+= len(lines)
+		if self.max_bytes and self._size>=self.max_bytes:
+			self.rotate()
+	
+	def _close_file(self):
+		if self._file is not None:
+			try:
+				self._file.close()
+			except OSError:
+				pass
+			self._file	= None
+	
+	### move log_file to log_file.1 (log_file.1 to log_file.2 etc.), called by the writer thread
+	def rotate(self):
+		self._close_file()
+		if self.backups>0:
+			for number in range(self.backups-1, 0, -1):
+				if os.path.exists('%s.%d' % (self.path, number)):
+					os.replace('%s.%d' % (self.path, number), '%s.%d' % (self.path, number+1))
+			os.replace(self.path, self.path + '.1')
+		else:
+			os.remove(self.path)
+	
+	### wait until every buffered record is written
+	def flush(self):
+		if self._thread is not None:
+			self._queue.join()
+	
+	def close(self):
+		with self._lock:
+			thread, self._thread	= self._thread, None
+		if thread is not None and thread.is_alive():
+			self._queue.put(None)
+			thread.join()
+	
+	def stats(self):
+		return {
+			"queued"	: self._queue.qsize(),
+			"written"	: self.written,
+			"dropped"	: self.dropped,
+			"sampled"	: self.sampled,
+			"errors"	: self.errors
+		}
+
+class LRUCache:
+	''' Thread safe least recently used cache with optional expiry and hit / miss counters '''
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,size=128,ttl=None,on_evict=None):
+		self.size		= size			# max. number of items
+		self.ttl		= ttl			# default lifetime of items in seconds (None never expires)
+		self.on_evict	= on_evict		# called with (key, value) for items pushed out by newer ones
+		self.hits		= 0
+		self.misses		= 0
+		self.evictions	= 0
+		self._items		= collections.OrderedDict()
+		self._lock		= threading.RLock()
+	
+	def __len__(self):
+		return len(self._items)
+	
+	def __contains__(self,key):
+		with self._lock:
+			if key in self._items:
+				expires	= self._items[key][1]
+				return expires is None or expires>time.time()
+		return False
+	
+	def get(self,key,default=None):
+		with self._lock:
+			if key in self._items:
+				value, expires	= self._items[key]
+				if expires is None or expires>time.time():
+					self._items.move_to_end(key)
+					self.hits	+= 1
+					return value
+				del self._items[key]
+			self.misses	+= 1
+		return default
+	
+	def set(self,key,value,ttl=None):
+		if ttl is None:
+			ttl		= self.ttl
+		evicted	= []
+		with self._lock:
+			if key in self._items:
+				self._items.move_to_end(key)
+			self._items[key]	= (value, time.time()+ttl if ttl is not None else None)
+			while len(self._items)>max(self.size,0):
+				old_key, (old_value, expires)	= self._items.popitem(last=False)
+				self.evictions	+= 1
+				evicted.append((old_key, old_value))
+		if self.on_evict:
+			for old_key, old_value in evicted:
+				self.on_evict(old_key, old_value)
+		return value
+	
+	def pop(self,key,default=None):
+		with self._lock:
+			if key in self._items:
+				return self._items.pop(key)[0]
+		return default
+	
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+	
+	def stats(self):
+		return {
+			"size"		: len(self._items),
+			"max_size"	: self.size,
+			"hits"		: self.hits,
+			"misses"	: self.misses,
+			"evictions"	: self.evictions
+		}
+
+class ProfileCache:
+	''' User profiles by id: kept in memory (and optionally in a Session) until they expire, failed lookups are kept for a shorter time
+		and concurrent lookups of the same id wait for a single request '''
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,request,size=1024,ttl=86400,error_ttl=60,session=None,session_key='profile'):
+		self.request		= request		# called with an id, returns the profile (a dict with 'error' for failed lookups)
+		self.ttl			= ttl
+		self.error_ttl		= error_ttl
+		self.session		= session
+		self.session_key	= session_key
+		self.cache			= LRUCache(size, ttl)
+		self.requests		= 0
+		self.coalesced		= 0
+		self._pending		= {}			# id => Event set once the running request is done
+		self._lock			= threading.Lock()
+	
+	def get(self,id,refresh=False):
+		id		= str(id)
+		while True:
+			if not refresh:
+				profile	= self.cache.get(id)
+				if profile is None:
+					profile	= self._session_get(id)
+				if profile is not None:
+					return profile
+			with self._lock:
+				event	= self._pending.get(id)
+				leader	= event is None
+				if leader:
+					event	= self._pending[id]	= threading.Event()
+				else:
+					self.coalesced	+= 1
+			if not leader:
+				# use the result of the running request (or request it again if it failed)
+				event.wait()
+				refresh	= False
+				continue
+			try:
+				return self._request(id)
+			finally:
+				with self._lock:
+					del self._pending[id]
+				event.set()
+	
+	def _request(self,id):
+		self.requests	+= 1
+		profile	= self.request(id)
+		if not isinstance(profile, dict) or 'error' in profile:
+			if self.error_ttl:
+				self.cache.set(id, profile, self.error_ttl)
+		else:
+			self.cache.set(id, profile, self.ttl)
+			if self.session is not None:
+				self.session.set(id, self.session_key, {"profile":profile, "expires":time.time()+self.ttl if self.ttl is not None else None})
+		return profile
+	
+	def _session_get(self,id):
+		if self.session is None:
+			return None
+		entry	= self.session.get(id, self.session_key)
+		if not isinstance(entry, dict) or 'profile' not in entry:
+			return None
+		expires	= entry.get('expires')
+		if expires is not None and expires<=time.time():
+			return None
+		self.cache.set(id, entry['profile'], expires-time.time() if expires is not None else None)
+		return entry['profile']
+	
+	def invalidate(self,id):
+		self.cache.pop(str(id))
+		if self.session is not None:
+			self.session.set(str(id), self.session_key, {})
+	
+	def stats(self):
+		stats	= self.cache.stats()
+		stats.update({
+			"requests"	: self.requests,
+			"coalesced"	: self.coalesced
+		})
+		return stats
+
+class Dispatcher:
+	''' Calls handlers registered by event kind from a bounded pool of worker threads, so webhooks can be acknowledged right away '''
+	
+	EVENT_KINDS			= ('text','postback','attachment','delivery','read','echo')
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,messaging,options={}):
+		default_settings	= {
+			"workers"		: 4,			# number of worker threads
+			"max_queue"		: 1000,			# max. number of messages waiting for a worker
+			"block"			: True,			# wait for free space when the queue is full (drop the message otherwise)
+			"timeout"		: None			# max. seconds to wait for free space before dropping the message
+		}
+		self.settings		= deep_dict_merge(default_settings,options)
+		self.messaging		= messaging
+		self.handlers		= {}
+		self.received		= 0
+		self.dropped		= 0
+		self.handled		= 0
+		self.errors			= 0
+		self.max_depth		= 0
+		self._lock			= threading.Lock()
+		self._queue			= queue.Queue(self.settings['max_queue'])
+		self._threads		= []
+		for i in range(max(self.settings['workers'],1)):
+			thread			= threading.Thread(target=self._work, name='phemia-dispatch-%d' % (i), daemon=True)
+			self._threads.append(thread)
+			thread.start()
+		# workers are daemon threads, queued messages are handled before the interpreter exits
+		atexit.register(self.close)
+	
+	### register handler for an event kind ('*' for every message), can be used as a decorator
+	def on(self,kind,handler=None):
+		if kind!='*' and kind not in self.EVENT_KINDS:
+			raise ValueError('Event kind "%s" is not supported.' % (kind))
+		if handler is None:
+			return lambda handler: self.on(kind,handler)
+		self.handlers.setdefault(kind,[]).append(handler)
+		return handler
+	
+	### queue a message for its handlers, returns False if it was dropped
+	def dispatch(self,message):
+		with self._lock:
+			self.received	+= 1
+		if not self._handlers_of(message):
+			return True
+		try:
+			self._queue.put(message, block=self.settings['block'], timeout=self.settings['timeout'])
+		except queue.Full:
+			with self._lock:
+				self.dropped	+= 1
+			self.messaging.log("Dispatcher queue is full, message dropped", level='warning')
+			return False
+		with self._lock:
+			self.max_depth	= max(self.max_depth, self._queue.qsize())
+		return True
+	
+	### handler for wsgi_app() / asgi_app()
+	def __call__(self,message):
+		return self.dispatch(message)
+	
+	### CGI: send the HTTP response right away, the script can keep on running the handlers
+	### NOTE: not available on the raw platform, its replies are printed to stdout (which is closed here)
+	def acknowledge(self,text='OK'):
+		if self.messaging.is_platform('raw'):
+			raise ValueError('Platform "raw" replies through stdout and can not be acknowledged early.')
+		sys.stdout.write('Status: 200 OK\r\nContent-Type: text/plain\r\n\r\n' + text)
+		sys.stdout.flush()
+		# the web server finishes the response once stdout is closed, later output is discarded
+		devnull	= os.open(os.devnull, os.O_WRONLY)
+		os.dup2(devnull, sys.stdout.fileno())
+		os.close(devnull)
+	
+	### receive every message of the current (CGI) request, acknowledge it and handle the messages
+	### (returns once they are handled, the script would otherwise exit before the workers run)
+	### NOTE: the raw platform is never acknowledged early, handlers print their replies as the response
+	def receive(self,acknowledge=True):
+		messages	= list(self.messaging.receive_all())
+		if acknowledge and not self.messaging.is_platform('raw'):
+			self.acknowledge()
+		for message in messages:
+			self.dispatch(message)
+		self.join()
+		return len(messages)
+	
+	### wait until every queued message is handled
+	def join(self):
+		self._queue.join()
+	
+	### handle remaining messages and stop workers
+	def close(self):
+		if not self._threads:
+			return
+		for thread in self._threads:
+			self._queue.put(None)
+		for thread in self._threads:
+			thread.join()
+		self._threads	= []
+	
+	def stats(self):
+		return {
+			"depth"		: self._queue.qsize(),
+			"max_depth"	: self.max_depth,
+			"received"	: self.received,
+			"dropped"	: self.dropped,
+			"handled"	: self.handled,
+			"errors"	: self.errors
+		}
+	
+	def _handlers_of(self,message):
+		return self.handlers.get(event_kind(message),[]) + self.handlers.get('*',[])
+	
+	def _work(self):
+		while True:
+			message	= self._queue.get()
+			try:
+				if message is None:
+					return
+				self.messaging.last_sender		= message['sender']
+				self.messaging.last_recipient	= message['recipient']
+				for handler in self._handlers_of(message):
+					try:
+						handler(message)
+					except Exception as e:
+						with self._lock:
+							self.errors	+= 1
+						self.messaging.log("Handler failed", error=repr(e))
+				with self._lock:
+					self.handled	+= 1
+			finally:
+				self._queue.task_done()
+
+def wsgi_app(messaging,handler):
+	''' WSGI application for long running servers: answers webhook verifications and calls handler(message) for every received message '''
+	def application(environ,start_response):
+		method	= environ.get('REQUEST_METHOD','GET')
+		if method=='GET':
+			challenge	= messaging.verify(parse_query(environ.get('QUERY_STRING')))
+			if challenge is None:
+				return _wsgi_response(start_response,'403 Forbidden','')
+			return _wsgi_response(start_response,'200 OK',challenge)
+		elif method=='POST':
+			# messages are handled while the body is read
+			try:
+				length	= int(environ.get('CONTENT_LENGTH') or 0)
+				# the input is only read to its end if the server terminates it, a missing length is an empty body otherwise
+				stream	= environ['wsgi.input'] if environ.get('wsgi.input_terminated') and length<=0 else _LimitedReader(environ['wsgi.input'],length)
+				for message in messaging.translate_stream(stream):
+					_call_handler(messaging,handler,message)
+			except ValueError:
+				return _wsgi_response(start_response,'400 Bad Request','')
+			return _wsgi_response(start_response,'200 OK','OK')
+		return _wsgi_response(start_response,'405 Method Not Allowed','')
+	return application
+
+def asgi_app(messaging,handler):
+	''' ASGI application for long running servers: answers webhook verifications and calls handler(message) for every received message
+		coroutine handlers are awaited, other handlers run in a thread pool so they can use the blocking API '''
+	async def application(scope,receive,send):
+		if scope['type']=='lifespan':
+			while True:
+				event	= await receive()
+				if event['type']=='lifespan.startup':
+					await send({"type": "lifespan.startup.complete"})
+				elif event['type']=='lifespan.shutdown':
+					await send({"type": "lifespan.shutdown.complete"})
+					return
+		if scope['type']!='http':
+			return
+		if scope['method']=='GET':
+			challenge	= messaging.verify(parse_query(scope.get('query_string',b'').decode('latin-1')))
+			if challenge is None:
+				return await _asgi_response(send,403,'')
+			return await _asgi_response(send,200,challenge)
+		elif scope['method']=='POST':
+			body	= b''
+			while True:
+				event	= await receive()
+				body	+= event.get('body',b'')
+				if not event.get('more_body'):
+					break
+			try:
+				with _stage_timer(messaging.metrics,'parse'):
+					data	= json.loads(body.decode('utf-8'))
+			except ValueError:
+				return await _asgi_response(send,400,'')
+			loop	= asyncio.get_running_loop()
+			for message in messaging.translate_all(data):
+				if inspect.iscoroutinefunction(handler):
+					try:
+						await handler(message)
+					except Exception as e:
+						messaging.log("Handler failed", error=repr(e))
+				else:
+					await loop.run_in_executor(messaging._async_executor(),_call_handler,messaging,handler,message)
+			return await _asgi_response(send,200,'OK')
+		return await _asgi_response(send,405,'')
+	return application
+
+_NO_TIMER	= contextlib.nullcontext()
+
+### timer of a stage if metrics are collected (the shared no-op context otherwise)
+def _stage_timer(metrics,stage):
+	if metrics is None:
+		return _NO_TIMER
+	return metrics.timer(stage)
+
+### file-like object that reads at most length bytes (WSGI apps must not read past CONTENT_LENGTH)
+class _LimitedReader:
+	def __init__(self,stream,length):
+		self.stream		= stream
+		self.remaining	= length
+	
+	def read(self,size=-1):
+		if self.remaining<=0:
+			return b''
+		if size<0 or size>self.remaining:
+			size	= self.remaining
+		data			= self.stream.read(size)
+		self.remaining	-= len(data)
+		return data
+
+### call a message handler, last sender / recipient are set for the thread it runs on
+def _call_handler(messaging,handler,message):
+	messaging.last_sender		= message['sender']
+	messaging.last_recipient	= message['recipient']
+	try:
+		handler(message)
+	except Exception as e:
+		messaging.log("Handler failed", error=repr(e))
+
+def _wsgi_response(start_response,status,text):
+	body	= str(text).encode('utf-8')
+	start_response(status,[('Content-Type','text/plain; charset=utf-8'),('Content-Length',str(len(body)))])
+	return [body]
+
+async def _asgi_response(send,status,text):
+	body	= str(text).encode('utf-8')
+	await send({"type": "http.response.start", "status": status, "headers": [(b'content-type', b'text/plain; charset=utf-8'), (b'content-length', str(len(body)).encode('latin-1'))]})
+	await send({"type": "http.response.body", "body": body})
+
+### kind of a received message: text, postback, attachment, delivery, read, echo (None if unknown)
+def event_kind(message):
+	other	= message['other'] if 'other' in message and message['other'] else {}
+	if other.get('is_echo'):
+		return 'echo'
+	if 'delivery' in other:
+		return 'delivery'
+	if 'read' in other:
+		return 'read'
+	if other.get('is_postback'):
+		return 'postback'
+	if 'attachment' in message and message['attachment']:
+		return 'attachment'
+	if 'text' in message and message['text'] is not None:
+		return 'text'
+	return None
+
+### kind of a raw facebook messaging event (the same as event_kind of its translation)
+def facebook_event_kind(event):
+	message	= event.get('message')
+	if message is not None and message.get('is_echo'):
+		return 'echo'
+	if 'delivery' in event:
+		return 'delivery'
+	if 'read' in event:
+		return 'read'
+	if 'postback' in event:
+		return 'postback'
+	if message is not None:
+		if message.get('attachments'):
+			return 'attachment'
+		return 'text'
+	return None
+
+def parse_query(query):
+	data	= {}
+	if query:
+		for key, value in urllib.parse.parse_qs(query, encoding='utf-8').items():
+			data[key]	= value[0]
+	return data
+
 def deep_dict_merge(d, u):
 	''' VIA http://stackoverflow.com/questions/3232943/update-value-of-a-nested-dictionary-of-varying-depth '''
 	for k, v in u.items():
-		if isinstance(v, collections.Mapping):
+		if isinstance(v, collections.abc.Mapping):
 			r = deep_dict_merge(d.get(k, {}), v)
 			d[k] = r
 		else:
@@ -749,3 +3175,57 @@ def get_attachment_type(file):
 		}
 	}
 '''
+
+def main(argv=None):
+	parser		= argparse.ArgumentParser(prog='python -m phemia', description='Phemia maintenance commands.')
+	commands	= parser.add_subparsers(dest='command')
+	
+	drain		= commands.add_parser('drain-outbox', help='deliver messages stored in the outbox')
+	drain.add_argument('outbox', nargs='?', help='outbox file (overrides the config file)')
+	drain.add_argument('--config', help='JSON file with Messaging options')
+	drain.add_argument('--access-token', default=os.environ.get('PHEMIA_ACCESS_TOKEN'), help='facebook access token (default: $PHEMIA_ACCESS_TOKEN)')
+	drain.add_argument('--limit', type=int, default=None, help='max. number of messages to deliver')
+	drain.add_argument('--loop', type=float, default=None, help='keep draining, waiting the given seconds between runs')
+	
+	sweep		= commands.add_parser('sweep-sessions', help='remove expired sessions')
+	sweep.add_argument('--config', help='JSON file with Session options')
+	sweep.add_argument('--ttl', type=float, default=None, help='seconds after the last update a session expires (overrides the config file)')
+	
+	args		= parser.parse_args(argv)
+	if args.command=='sweep-sessions':
+		options		= {}
+		if args.config:
+			with open(args.config, 'r') as config:
+				options	= json.load(config)
+		session		= Session(options)
+		try:
+			print('removed: {0}'.format(session.sweep(args.ttl)))
+		finally:
+			session.close()
+		return 0
+	elif args.command=='drain-outbox':
+		options		= {}
+		if args.config:
+			with open(args.config, 'r') as config:
+				options	= json.load(config)
+		options		= deep_dict_merge(options,{"outbox": {}, "facebook": {}})
+		if args.outbox:
+			options['outbox']['path']	= args.outbox
+		if args.access_token:
+			options['facebook']['access_token']	= args.access_token
+		messaging	= Messaging(options)
+		if not messaging.settings['outbox']['path']:
+			parser.error('no outbox file is given')
+		while True:
+			stats	= messaging.drain_outbox(args.limit)
+			print('sent: {sent}, retried: {retried}, failed: {failed}'.format(**stats))
+			if args.loop is None:
+				break
+			time.sleep(args.loop)
+		messaging.close()
+		return 0
+	parser.print_help()
+	return 1
+
+if __name__ == '__main__':
+	sys.exit(main())
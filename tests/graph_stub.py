@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+'''
+	Local stand-in for the Graph API send endpoints used by the tests
+	(POST /v2.6/me/messages and batch requests to /), it records every call and the peak number of requests in flight.
+	
+	python -m unittest discover -s tests
+'''
+
+import json
+import time
+import threading
+import http.server
+import urllib.parse
+
+class GraphStub:
+	''' Threaded HTTP server answering like the Graph API, recipients listed in errors get the given error back '''
+	
+	##### CONSTRUCTOR #####
+	def __init__(self,delay=0,errors={}):
+		self.delay		= delay			# seconds every request takes
+		self.errors		= dict(errors)	# recipient id => (status code, error dict)
+		self.calls		= []			# (path, body) of every request in the order they arrived
+		self.in_flight	= 0
+		self.max_in_flight	= 0
+		self._lock		= threading.Lock()
+		stub			= self
+		
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version	= 'HTTP/1.1'
+			wbufsize			= -1			# headers and body in one packet (delayed ACKs slow down keep-alive otherwise)
+			
+			def do_POST(self):
+				body	= self.rfile.read(int(self.headers.get('Content-Length', 0)))
+				status, data	= stub.handle(self.path, body)
+				out		= json.dumps(data).encode('utf-8')
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(out)))
+				self.end_headers()
+				self.wfile.write(out)
+			
+			def log_message(self,*args):
+				pass
+		
+		self.server		= http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.server.daemon_threads	= True
+		self.url		= 'http://127.0.0.1:%d/' % (self.server.server_port)
+		self._thread	= threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+		self._thread.start()
+	
+	def handle(self,path,body):
+		with self._lock:
+			self.in_flight		+= 1
+			self.max_in_flight	= max(self.max_in_flight, self.in_flight)
+		try:
+			if self.delay:
+				time.sleep(self.delay)
+			with self._lock:
+				self.calls.append((path, body))
+			if path.startswith('/v2.6/me/messages'):
+				return self._message(json.loads(body.decode('utf-8')))
+			batch	= json.loads(urllib.parse.parse_qs(body.decode('utf-8'))['batch'][0])
+			results	= []
+			for request in batch:
+				fields			= urllib.parse.parse_qs(request['body'])
+				message			= {key: json.loads(value[0]) if key in ('recipient', 'message') else value[0] for key, value in fields.items()}
+				status, data	= self._message(message)
+				results.append({"code": status, "headers": [], "body": json.dumps(data)})
+			return 200, results
+		finally:
+			with self._lock:
+				self.in_flight	-= 1
+	
+	def _message(self,message):
+		recipient	= str(message['recipient']['id'])
+		if recipient in self.errors:
+			return self.errors[recipient]
+		return 200, {"recipient_id": recipient, "message_id": "mid.%d" % (len(self.calls))}
+	
+	### texts of the messages received (in order), batched ones included
+	def texts(self):
+		texts	= []
+		for path, body in list(self.calls):
+			if path.startswith('/v2.6/me/messages'):
+				texts.append(json.loads(body.decode('utf-8'))['message'].get('text'))
+			else:
+				for request in json.loads(urllib.parse.parse_qs(body.decode('utf-8'))['batch'][0]):
+					texts.append(json.loads(urllib.parse.parse_qs(request['body'])['message'][0]).get('text'))
+		return texts
+	
+	### messaging object sending to this server
+	def messaging(self,options={}):
+		import phemia
+		messaging	= phemia.Messaging(phemia.deep_dict_merge({"facebook": {"access_token": "TOKEN"}}, options))
+		messaging.FACEBOOK_GRAPH_URL_BASE	= self.url
+		messaging.FACEBOOK_GRAPH_URL		= self.url + messaging.FACEBOOK_GRAPH_VERSION + '/'
+		return messaging
+	
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
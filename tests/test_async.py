@@ -0,0 +1,52 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from graph_stub import GraphStub
+
+class SendAsyncTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.stub		= GraphStub(delay=0.05, errors={"bad": (400, {"error": {"message": "Invalid recipient", "type": "OAuthException", "code": 100}})})
+		self.messaging	= self.stub.messaging({"async": {"concurrency": 4}, "http": {"pool_maxsize": 4}})
+	
+	def tearDown(self):
+		self.messaging.close()
+		self.stub.close()
+	
+	def test_send_async(self):
+		result	= asyncio.run(self.messaging.send_async({"recipient": {"id": "1"}, "text": "hello"}))
+		self.assertEqual(result['recipient'], {"id": "1"})
+		self.assertEqual(result['error'], {})
+		self.assertEqual(self.stub.texts(), ['hello'])
+	
+	def test_send_all_async_keeps_order(self):
+		messages	= [{"recipient": {"id": str(i)}, "text": "message %d" % (i)} for i in range(20)]
+		results		= asyncio.run(self.messaging.send_all_async(messages))
+		self.assertEqual([result['recipient']['id'] for result in results], [str(i) for i in range(20)])
+		self.assertEqual(sorted(self.stub.texts()), sorted(message['text'] for message in messages))
+	
+	def test_send_all_async_concurrency_limit(self):
+		messages	= [{"recipient": {"id": str(i)}, "text": "x"} for i in range(16)]
+		asyncio.run(self.messaging.send_all_async(messages))
+		self.assertEqual(len(self.stub.calls), 16)
+		self.assertLessEqual(self.stub.max_in_flight, 4)
+		self.assertGreater(self.stub.max_in_flight, 1)
+	
+	def test_send_all_async_errors(self):
+		results	= asyncio.run(self.messaging.send_all_async([{"recipient": {"id": "bad"}, "text": "x"}, {"recipient": {"id": "2"}, "text": "y"}]))
+		self.assertEqual(results[0]['error']['code'], 100)
+		self.assertEqual(results[0]['error']['platform'], 'facebook')
+		self.assertEqual(results[1]['error'], {})
+	
+	def test_reply_async_uses_last_sender(self):
+		self.messaging.last_sender	= {"id": "42"}
+		result	= asyncio.run(self.messaging.reply_async({"text": "reply"}))
+		self.assertEqual(result['recipient'], {"id": "42"})
+
+if __name__ == '__main__':
+	unittest.main()
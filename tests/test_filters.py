@@ -0,0 +1,40 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from phemia import Messaging, event_kind
+
+def receipt(sender,kind,watermark):
+	return {"sender": {"id": sender}, "recipient": {"id": "PAGE"}, "timestamp": 1500000000000, kind: {"watermark": watermark}}
+
+def webhook(*events):
+	return {"object": "page", "entry": [{"id": "PAGE", "time": 1500000000000, "messaging": list(events)}]}
+
+class WatermarkTest(unittest.TestCase):
+	
+	def test_receipts_are_collected(self):
+		messaging	= Messaging({"filters": {"watermarks": True}})
+		events		= list(messaging.translate_all(webhook(receipt('1','read',10), receipt('1','read',30), receipt('1','read',20), receipt('2','delivery',5))))
+		self.assertEqual(events, [])
+		self.assertEqual(messaging.pop_watermarks(), {"1": {"read": 30}, "2": {"delivery": 5}})
+		self.assertEqual(messaging.watermarks, {})
+	
+	def test_senders_are_bounded(self):
+		messaging	= Messaging({"filters": {"watermarks": True, "max_watermarks": 2}})
+		events		= list(messaging.translate_all(webhook(*[receipt(str(i),'read',i+1) for i in range(5)]+[receipt('0','read',100)])))
+		self.assertEqual(messaging.pop_watermarks(), {"0": {"read": 100}, "1": {"read": 2}})
+		# receipts of further senders are not lost, they are translated
+		self.assertEqual([event_kind(event) for event in events], ['read']*3)
+		self.assertEqual([event['sender']['id'] for event in events], ['2','3','4'])
+	
+	def test_malformed_receipts_are_translated(self):
+		messaging	= Messaging({"filters": {"watermarks": True}})
+		malformed	= [dict(receipt('1','read',1), read="yes"), dict(receipt('1','delivery',1), delivery=[1]), receipt('1','read','soon')]
+		events		= list(messaging.translate_all(webhook(*malformed)))
+		self.assertEqual(len(events), 3)
+		self.assertEqual(messaging.pop_watermarks(), {})
+
+if __name__ == '__main__':
+	unittest.main()
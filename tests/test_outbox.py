@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from graph_stub import GraphStub
+
+class OutboxTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.directory	= tempfile.mkdtemp()
+		self.path		= os.path.join(self.directory, 'outbox.db')
+		self.stub		= GraphStub(errors={
+			"limited"	: (400, {"error": {"message": "Calls to this api have exceeded the rate limit.", "type": "OAuthException", "code": 613}}),
+			"invalid"	: (400, {"error": {"message": "Invalid recipient", "type": "OAuthException", "code": 100}})
+		})
+		self.messagings	= []
+	
+	def tearDown(self):
+		for messaging in self.messagings:
+			messaging.close()
+		self.stub.close()
+		shutil.rmtree(self.directory)
+	
+	def messaging(self,options={}):
+		messaging	= self.stub.messaging(dict({"outbox": {"path": self.path, "backoff": 0, "retries": 3}}, **options))
+		self.messagings.append(messaging)
+		return messaging
+	
+	def test_send_stores_until_drained(self):
+		messaging	= self.messaging()
+		result		= messaging.send({"recipient": {"id": "1"}, "text": "hello"})
+		self.assertIn('outbox', result['other'])
+		self.assertEqual(self.stub.calls, [])
+		self.assertEqual(messaging.outbox.count(), 1)
+		self.assertEqual(messaging.drain_outbox(), {"sent": 1, "retried": 0, "failed": 0})
+		self.assertEqual(self.stub.texts(), ['hello'])
+		self.assertEqual(messaging.outbox.count(), 0)
+		self.assertEqual(messaging.outbox.count('done'), 1)
+		self.assertEqual(messaging.drain_outbox(), {"sent": 0, "retried": 0, "failed": 0})
+	
+	def test_survives_new_process(self):
+		self.messaging().send({"recipient": {"id": "1"}, "text": "stored"})
+		self.assertEqual(self.messaging().drain_outbox()['sent'], 1)
+		self.assertEqual(self.stub.texts(), ['stored'])
+	
+	def test_retries_and_failures(self):
+		messaging	= self.messaging()
+		messaging.send({"recipient": {"id": "limited"}, "text": "a"})
+		messaging.send({"recipient": {"id": "invalid"}, "text": "b"})
+		self.assertEqual(messaging.drain_outbox(), {"sent": 0, "retried": 1, "failed": 1})
+		self.assertEqual(messaging.drain_outbox(), {"sent": 0, "retried": 1, "failed": 0})
+		self.assertEqual(messaging.drain_outbox(), {"sent": 0, "retried": 0, "failed": 1})
+		self.assertEqual(messaging.outbox.count('failed'), 2)
+		self.assertEqual(messaging.outbox.count(), 0)
+	
+	def test_recipient_waits_for_retried_message(self):
+		messaging	= self.messaging({"outbox": {"path": self.path, "backoff": 60, "retries": 3}})
+		messaging.send({"recipient": {"id": "limited"}, "text": "first"})
+		messaging.send({"recipient": {"id": "limited"}, "text": "second"})
+		messaging.send({"recipient": {"id": "2"}, "text": "other"})
+		self.assertEqual(messaging.drain_outbox(), {"sent": 1, "retried": 1, "failed": 0})
+		self.assertEqual(self.stub.texts(), ['first', 'other'])
+	
+	def test_limit(self):
+		messaging	= self.messaging()
+		for i in range(5):
+			messaging.send({"recipient": {"id": str(i)}, "text": str(i)})
+		self.assertEqual(messaging.drain_outbox(2)['sent'], 2)
+		self.assertEqual(messaging.outbox.count(), 3)
+	
+	def test_concurrent_drainers_send_once_in_order(self):
+		messaging	= self.messaging()
+		for i in range(60):
+			messaging.send({"recipient": {"id": str(i%5)}, "text": "%d:%d" % (i%5, i)})
+		self.stub.delay	= 0.005
+		drainers	= [self.messaging() for i in range(3)]
+		stats		= []
+		threads		= [threading.Thread(target=lambda drainer: stats.append(drainer.drain_outbox()), args=(drainer,)) for drainer in drainers]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		texts		= self.stub.texts()
+		self.assertEqual(len(texts), 60)
+		self.assertEqual(len(set(texts)), 60)
+		self.assertEqual(sum(item['sent'] for item in stats), 60)
+		received	= {}
+		for text in texts:
+			recipient, number	= text.split(':')
+			received.setdefault(recipient, []).append(int(number))
+		for numbers in received.values():
+			self.assertEqual(numbers, sorted(numbers))
+	
+	def test_claimed_message_is_taken_over_after_lease(self):
+		messaging	= self.messaging()
+		messaging.send({"recipient": {"id": "1"}, "text": "claimed"})
+		connection	= messaging.outbox._connection()
+		# a drainer claimed it and crashed
+		connection.execute('UPDATE outbox SET status=\'sending\', next_try=?', (time.time()+300,))
+		self.assertEqual(messaging.drain_outbox()['sent'], 0)
+		connection.execute('UPDATE outbox SET next_try=?', (time.time()-1,))
+		self.assertEqual(messaging.drain_outbox()['sent'], 1)
+		self.assertEqual(self.stub.texts(), ['claimed'])
+
+if __name__ == '__main__':
+	unittest.main()
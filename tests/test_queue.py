@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+import time
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from graph_stub import GraphStub
+
+class SendQueueTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.stub		= GraphStub(errors={"limited": (400, {"error": {"message": "Calls to this api have exceeded the rate limit.", "type": "OAuthException", "code": 613}})})
+		self.results	= []
+		self.messaging	= self.stub.messaging({"queue": {"enabled": True, "workers": 4, "backoff": 0, "max_backoff": 0, "retries": 2, "callback": lambda compiled, result: self.results.append(result)}})
+	
+	def tearDown(self):
+		self.messaging.close()
+		self.stub.close()
+	
+	def test_send_returns_before_delivery(self):
+		result	= self.messaging.send({"recipient": {"id": "1"}, "text": "hello"})
+		self.assertEqual(result['other'], {"queued": True})
+		self.assertTrue(self.messaging.flush(5))
+		self.assertEqual(self.stub.texts(), ['hello'])
+		self.assertEqual(len(self.results), 1)
+	
+	def test_order_per_recipient(self):
+		for i in range(40):
+			self.messaging.send({"recipient": {"id": str(i%5)}, "text": "%d:%d" % (i%5, i)})
+		self.assertTrue(self.messaging.flush(10))
+		received	= {}
+		for path, body in self.stub.calls:
+			recipient, number	= json.loads(body.decode('utf-8'))['message']['text'].split(':')
+			received.setdefault(recipient, []).append(int(number))
+		self.assertEqual(sum(len(numbers) for numbers in received.values()), 40)
+		for numbers in received.values():
+			self.assertEqual(numbers, sorted(numbers))
+	
+	def test_stats(self):
+		for i in range(100):
+			self.messaging.send({"recipient": {"id": str(i)}, "text": "x"})
+		self.assertTrue(self.messaging.flush(10))
+		self.assertEqual(self.messaging.queue.stats(), {"queued": 0, "sent": 100, "failed": 0, "retried": 0})
+	
+	def test_retries_rate_limits(self):
+		self.messaging.send({"recipient": {"id": "limited"}, "text": "x"})
+		self.assertTrue(self.messaging.flush(5))
+		self.assertEqual(len(self.stub.calls), 3)
+		self.assertEqual(self.messaging.queue.stats()['failed'], 1)
+		self.assertEqual(self.messaging.queue.stats()['retried'], 2)
+		self.assertEqual(self.results[0]['error']['code'], 613)
+	
+	def test_closed_queue(self):
+		queue	= self.messaging._send_queue()
+		queue.close()
+		queue.close()
+		with self.assertRaises(ValueError):
+			queue.put(self.messaging.compile({"recipient": {"id": "1"}, "text": "x"}))
+
+class RateLimitTest(unittest.TestCase):
+	
+	def test_rate(self):
+		stub		= GraphStub()
+		messaging	= stub.messaging({"queue": {"enabled": True, "workers": 2, "rate": 20, "burst": 1}})
+		try:
+			start	= time.monotonic()
+			for i in range(11):
+				messaging.send({"recipient": {"id": str(i)}, "text": "x"})
+			self.assertTrue(messaging.flush(10))
+			self.assertGreaterEqual(time.monotonic()-start, 0.45)
+			self.assertEqual(len(stub.calls), 11)
+		finally:
+			messaging.close()
+			stub.close()
+
+if __name__ == '__main__':
+	unittest.main()
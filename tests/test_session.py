@@ -0,0 +1,304 @@
+# -*- coding: UTF-8 -*-
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from phemia import Session, main
+
+class RawSessionTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.directory	= tempfile.mkdtemp()
+		self.sessions	= []
+	
+	def tearDown(self):
+		for session in self.sessions:
+			session.close()
+		shutil.rmtree(self.directory)
+	
+	def session(self,options={}):
+		session		= Session(dict({"raw": {"path": self.directory}}, **options))
+		self.sessions.append(session)
+		return session
+	
+	def test_get_set_remove(self):
+		session		= self.session()
+		self.assertIsNone(session.get('1','name'))
+		self.assertEqual(session.set('1','name','Anna'), 'Anna')
+		self.assertEqual(self.session().get('1','name'), 'Anna')
+		self.assertEqual(session.append('1','history','a',max_length=2), ['a'])
+		session.append('1','history','b',max_length=2)
+		self.assertEqual(session.append('1','history','c',max_length=2), ['b','c'])
+		session.remove('1')
+		self.assertIsNone(session.get('1','name'))
+	
+	def test_writes_are_atomic(self):
+		session		= self.session()
+		session.set('1','text','x'*100000)
+		errors		= []
+		def read():
+			for i in range(200):
+				try:
+					value	= session.get('1','text')
+					if value is not None and len(value)!=100000:
+						errors.append(len(value))
+				except ValueError as error:
+					errors.append(error)
+		reader		= threading.Thread(target=read)
+		reader.start()
+		for i in range(50):
+			session.set('1','text',str(i%10)*100000)
+		reader.join()
+		self.assertEqual(errors, [])
+		self.assertEqual([name for name in os.listdir(self.directory) if name.startswith('.tmp-')], [])
+	
+	def test_threads_do_not_lose_updates(self):
+		session		= self.session()
+		def count():
+			for i in range(50):
+				with session.update('1') as data:
+					data['count']	= data.get('count',0)+1
+		threads		= [threading.Thread(target=count) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(session.get('1','count'), 200)
+	
+	def test_close_releases_lock_files(self):
+		session		= self.session()
+		for i in range(10):
+			session.set(str(i),'name','x')
+		self.assertTrue(session._stripe_files)
+		handles		= list(session._stripe_files.values())
+		session.close()
+		self.assertEqual(session._stripe_files, {})
+		self.assertTrue(all(handle.closed for handle in handles))
+		session.set('1','name','y')
+		self.assertEqual(session.get('1','name'), 'y')
+	
+	def test_context_manager_closes(self):
+		with self.session({"cache": {"enabled": True}}) as session:
+			session.set('1','name','cached')
+		self.assertEqual(session._stripe_files, {})
+		self.assertEqual(self.session().get('1','name'), 'cached')
+	
+	@unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+	def test_forked_workers_lock_each_other(self):
+		session		= self.session()
+		session.set('1','count',0)		# lock files are opened before the fork, like in a pre-fork server
+		def count():
+			for i in range(100):
+				with session.update('1') as data:
+					data['count']	= data.get('count',0)+1
+		pids		= []
+		for worker in range(3):
+			pid		= os.fork()
+			if pid==0:
+				status	= 1
+				try:
+					count()
+					status	= 0
+				finally:
+					os._exit(status)
+			pids.append(pid)
+		count()
+		for pid in pids:
+			self.assertEqual(os.waitpid(pid,0)[1], 0)
+		self.assertEqual(self.session().get('1','count'), 400)
+
+class SqliteSessionTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.directory	= tempfile.mkdtemp()
+		self.sessions	= []
+	
+	def tearDown(self):
+		for session in self.sessions:
+			session.close()
+		shutil.rmtree(self.directory)
+	
+	def session(self,platform='sqlite',options={}):
+		session		= Session(dict({"platform": platform, "raw": {"path": self.directory}, "sqlite": {"path": os.path.join(self.directory, 'sessions.db')}}, **options))
+		self.sessions.append(session)
+		return session
+	
+	def test_same_results_as_raw(self):
+		results		= {}
+		for platform in ('raw','sqlite'):
+			session		= self.session(platform)
+			steps		= [
+				session.get('1','name'),
+				session.set('1','name','Anna'),
+				session.get('1','name'),
+				session.append('1','history',{"text": "a"},max_length=2),
+				session.append('1','history',{"text": "b"},max_length=2),
+				session.append('1','history',{"text": "c"},max_length=2),
+				session.append('1','history'),
+				session.set_path('1',['profile','address','city'],'Berlin'),
+				session.get_path('1',['profile','address','city']),
+				session.set_path('1',['history',0,'text'],'x'),
+				session.get_path('1',['history',0]),
+				session.get_path('1',['history',5]),
+				session.set_many('1',{"a": 1, "b": [1,2]}),
+				session.get_many('1',['a','b','missing'])
+			]
+			with session.update('1') as data:
+				data['a']	= 2
+				del data['b']
+			steps.append(session.get_many('1',['a','b']))
+			steps.append([(id, {key: value for key, value in data.items() if key!='last_update'}) for id, data in session.load_many(['1','2'])])
+			session.remove('1')
+			steps.append(session.get('1','name'))
+			results[platform]	= steps
+		self.assertEqual(results['raw'], results['sqlite'])
+	
+	def test_failed_update_is_rolled_back(self):
+		session		= self.session()
+		session.set('1','name','Anna')
+		with self.assertRaises(KeyError):
+			with session.update('1') as data:
+				data['name']	= 'Bob'
+				raise KeyError('name')
+		self.assertEqual(session.get('1','name'), 'Anna')
+	
+	def test_threads_do_not_lose_updates(self):
+		session		= self.session()
+		def count():
+			for i in range(50):
+				with session.update('1') as data:
+					data['count']	= data.get('count',0)+1
+				session.append('1','items',i,max_length=1000)
+		threads		= [threading.Thread(target=count) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(session.get('1','count'), 200)
+		self.assertEqual(len(session.get('1','items')), 200)
+	
+	@unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+	def test_forked_workers_do_not_lose_updates(self):
+		session		= self.session()
+		session.set('1','count',0)		# the connection is opened before the fork
+		def count():
+			for i in range(50):
+				with session.update('1') as data:
+					data['count']	= data.get('count',0)+1
+		pids		= []
+		for worker in range(3):
+			pid		= os.fork()
+			if pid==0:
+				status	= 1
+				try:
+					count()
+					status	= 0
+				finally:
+					os._exit(status)
+			pids.append(pid)
+		count()
+		for pid in pids:
+			self.assertEqual(os.waitpid(pid,0)[1], 0)
+		self.assertEqual(self.session().get('1','count'), 200)
+
+class ExpiryTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.directory	= tempfile.mkdtemp()
+		self.sessions	= []
+	
+	def tearDown(self):
+		for session in self.sessions:
+			session.close()
+		shutil.rmtree(self.directory)
+	
+	def session(self,platform='raw',options={}):
+		session		= Session(dict({"platform": platform, "ttl": 60, "raw": {"path": self.directory}, "sqlite": {"path": os.path.join(self.directory, 'sessions.db')}}, **options))
+		self.sessions.append(session)
+		return session
+	
+	### make the session look like it was last updated an hour ago
+	def age(self,session,id):
+		if session.is_platform('raw'):
+			file	= session.file_name(id)
+			with open(file, 'r') as handle:
+				data	= json.load(handle)
+			data['last_update']	-= 3600
+			with open(file, 'w') as handle:
+				json.dump(data, handle)
+			os.utime(file, (time.time()-3600, time.time()-3600))
+		else:
+			session._sqlite().execute('UPDATE sessions SET value=CAST(value AS INTEGER)-3600 WHERE id=? AND key=\'last_update\'', (id,))
+	
+	def test_expired_sessions_read_as_empty(self):
+		for platform in ('raw','sqlite'):
+			session		= self.session(platform)
+			session.set('1','name','Anna')
+			session.set('2','name','Bob')
+			self.age(session,'1')
+			self.assertIsNone(session.get('1','name'))
+			self.assertEqual(session.get_many('1',['name']), {"name": None})
+			self.assertEqual(session.get('2','name'), 'Bob')
+			self.assertEqual(session.append('1','history','a'), ['a'])
+	
+	def test_refreshed_session_is_kept(self):
+		for platform in ('raw','sqlite'):
+			session		= self.session(platform)
+			session.set('1','name','Anna')
+			# another process updates the session after it was read as expired, before it is removed
+			self.assertFalse(session._expire('1'))
+			self.assertEqual(session.get('1','name'), 'Anna')
+			self.age(session,'1')
+			self.assertTrue(session._expire('1'))
+			self.assertIsNone(session.get('1','name'))
+	
+	def test_sweep(self):
+		for platform in ('raw','sqlite'):
+			session		= self.session(platform)
+			for id in ('1','2','3'):
+				session.set(id,'name',id)
+			self.age(session,'1')
+			self.age(session,'3')
+			self.assertEqual(session.sweep(), 2)
+			self.assertEqual(session.sweep(), 0)
+			self.assertEqual(session.get('2','name'), '2')
+		with self.assertRaises(ValueError):
+			Session().sweep()
+	
+	def test_sweep_default_path(self):
+		cwd			= os.getcwd()
+		os.chdir(self.directory)
+		try:
+			session		= Session({"ttl": 60})
+			self.sessions.append(session)
+			session.set('1','name','Anna')
+			self.age(session,'1')
+			self.assertEqual(session.sweep(), 1)
+			self.assertFalse(os.path.exists(os.path.join(self.directory, '1.txt')))
+		finally:
+			os.chdir(cwd)
+	
+	def test_sweep_command(self):
+		session		= self.session()
+		session.set('1','name','Anna')
+		session.set('2','name','Bob')
+		self.age(session,'1')
+		config		= os.path.join(self.directory, 'config.json')
+		with open(config, 'w') as handle:
+			json.dump({"raw": {"path": self.directory}}, handle)
+		output		= io.StringIO()
+		with contextlib.redirect_stdout(output):
+			self.assertEqual(main(['sweep-sessions', '--config', config, '--ttl', '60']), 0)
+		self.assertEqual(output.getvalue().strip(), 'removed: 1')
+		self.assertEqual(session.get('2','name'), 'Bob')
+
+if __name__ == '__main__':
+	unittest.main()